@@ -5,7 +5,7 @@ import uuid
 import threading
 import httpx
 import datetime
-from typing import Callable, Any, List, Union
+from typing import Callable, Any, List, Optional, Union
 import os
 import logging
 import sys
@@ -14,6 +14,7 @@ import schemes
 from localization import get_string, set_language, get_available_languages, get_current_language
 
 URL_DOMAIN = "gog-lab.org"
+USE_COMPACT_ENCODING = True  # サーバーからのイベントをmsgpackで受け取る
 os.environ["debug"] = "True"
 
 def resource_path(relative_path):
@@ -28,7 +29,7 @@ class WebSocketClient:
     """Manages the WebSocket connection and communication, independent of the UI."""
     def __init__(self,
                  on_open: Callable[[], None],
-                 on_message: Callable[[str], None],
+                 on_message: Callable[[str | bytes], None],
                  on_error: Callable[[str], None],
                  on_close: Callable[[], None]):
         self.ws_app = None
@@ -36,13 +37,14 @@ class WebSocketClient:
         self.is_connected = False
         self.nickname = ""
         self.user_id: uuid.UUID = uuid.uuid5(uuid.NAMESPACE_DNS, str(uuid.getnode()))
+        self.decoder = schemes.Compact_decoder()
 
         self._on_open_callback = on_open
         self._on_message_callback = on_message
         self._on_error_callback = on_error
         self._on_close_callback = on_close
 
-    def _on_message(self, ws, message: str):
+    def _on_message(self, ws, message: str | bytes):
         if os.environ.get('debug') == 'True':
             logging.info(f"RECV: {message}")
         self._on_message_callback(message)
@@ -69,7 +71,10 @@ class WebSocketClient:
         if self.is_connected:
             return
         self.nickname = nickname
+        self.decoder = schemes.Compact_decoder()
         uri = f"wss://{URL_DOMAIN}/{game_id}/"
+        if USE_COMPACT_ENCODING:
+            uri += f"?encoding={schemes.COMPACT_ENCODING}"
         self.ws_app = websocket.WebSocketApp(uri,
                                   on_open=self._on_open,
                                   on_message=self._on_message,
@@ -107,11 +112,17 @@ class GameClientControl(ft.Column):
         )
         self.countdown_thread = None
         self.countdown_stop_event = threading.Event()
-        self.update_thread = None
-        self.update_stop_event = threading.Event()
         self.is_ready_sent = False
         self.last_question_sent = None
+        self.partial_response: Optional[ft.Control] = None
         self.game_is_over = False
+        self.game_id: Optional[str] = None                  # 接続中のゲームID
+        self.last_seq = 0                                   # REST APIで取得済みのゲーム状態のシーケンス番号
+        self.syncing = False                                # 取りこぼしたメッセージを取得中
+        self.sync_lock = threading.Lock()                   # WebSocketと差分取得のスレッドでの表示済みメッセージの更新
+        self.current_status = None                          # 表示中のゲームの進行状態
+        self.participants: dict[uuid.UUID, str] = {}        # 参加者（user_id -> ニックネーム）
+        self.shown_messages: set[tuple] = set()             # 表示済みのメッセージ（重複表示を防ぐ）
 
         self._event_handlers = {
             "res_question": self._handle_res_question,
@@ -121,6 +132,7 @@ class GameClientControl(ft.Column):
             "timeup": self._handle_game_end,
             "result": self._handle_game_end,
             "response": self._handle_response,
+            "status": self._handle_status_event,
         }
         
         self._init_ui_components()
@@ -287,27 +299,16 @@ class GameClientControl(ft.Column):
         self.ai_response_text.value = get_string("ai_response_placeholder")
         self.status_panel.visible = False
         self.chat_area.controls.clear()
+        self._reset_game_state()
         self.update()
 
         try:
-            api_url = f"https://{URL_DOMAIN}/{game_id}/?user_id={self.ws_client.user_id}"
-            response = httpx.get(api_url)
-            response.raise_for_status()
-            
-            game_data = schemes.GameData_Res.model_validate(response.json())
-            
-            for message in game_data.messages:
-                self._add_formatted_message(message)
-            
-            self._handle_status(game_data)
+            self.game_id = game_id
+            game_data = self._fetch_game_data(game_id)
+            self._apply_game_data(game_data)
             self.ws_client.connect(game_id, nickname)
             self._set_ui_for_connected(True)
 
-            # Start periodic updates
-            self.update_stop_event.clear()
-            self.update_thread = threading.Thread(target=self._periodic_update_logic, daemon=True)
-            self.update_thread.start()
-
         except httpx.HTTPStatusError as exc:
             if exc.response.status_code == 404:
                 self._show_error_dialog(get_string("error_dialog_title"), get_string("http_error_404"))
@@ -322,12 +323,9 @@ class GameClientControl(ft.Column):
             error_message = get_string("data_error_dialog_content")
             self._show_error_dialog(get_string("data_error_dialog_title"), error_message)
             print(f"ValidationError: {exc}")
-            if 'response' in locals() and response:
-                print("Received data:", response.text)
             self.connect_button.disabled = False
 
     def _disconnect_click(self, e):
-        self.update_stop_event.set()
         self.ws_client.disconnect()
         self._set_ui_for_connected(False)
         self.connect_button.disabled = False
@@ -369,9 +367,14 @@ class GameClientControl(ft.Column):
     def _on_ws_open(self):
         self._add_raw_message_to_chat(get_string("connected", user_id=self.ws_client.user_id))
 
-    def _on_ws_message(self, message: str):
+    def _on_ws_message(self, message: str | bytes):
         try:
-            event = schemes.WSEvent.model_validate({"root":json.loads(message)}).root
+            if isinstance(message, bytes):
+                event = self.ws_client.decoder.decode(message)
+                if event is None:  # user_idの対応表の更新のみ
+                    return
+            else:
+                event = schemes.ws_event_adapter.validate_json(message)
             
             handler = self._event_handlers.get(event.type)
             if handler:
@@ -379,7 +382,7 @@ class GameClientControl(ft.Column):
             else:
                 print(f"No handler for event type: {event.type}")
 
-        except (ValidationError, json.JSONDecodeError) as e:
+        except (ValidationError, json.JSONDecodeError, ValueError, KeyError) as e:
             self._add_raw_message_to_chat(get_string("receive_error", message=message))
             print(f"Error parsing message: {e}")
 
@@ -388,7 +391,6 @@ class GameClientControl(ft.Column):
 
     def _on_ws_close(self):
         self.countdown_stop_event.set()
-        self.update_stop_event.set()
         self._add_raw_message_to_chat(get_string("disconnected"))
         self._handle_disconnect(None)
         self.connect_button.disabled = False
@@ -402,7 +404,15 @@ class GameClientControl(ft.Column):
                 self.chat_area.controls.remove(placeholder)
             self.last_question_sent = None
 
+        # 途中経過は確定した内容が届いたら置き換える
+        if self.partial_response:
+            if self.partial_response in self.chat_area.controls:
+                self.chat_area.controls.remove(self.partial_response)
+            self.partial_response = None
         self._add_raw_message_to_chat(f"{data.text}", color=ft.Colors.BLUE)
+        if data.partial:
+            self.partial_response = self.chat_area.controls[-1]
+            return
         self._set_game_controls_enabled(True)
 
     def _handle_res_question(self, data: schemes.Res_Question):
@@ -448,6 +458,7 @@ class GameClientControl(ft.Column):
         self.countdown_stop_event.set()
         self.game_id_input.value = str(data.game_id)
         self.chat_area.controls.clear()
+        self._reset_game_state()
         self._add_raw_message_to_chat(get_string("new_game_created", game_id=data.game_id), color=ft.Colors.BLUE)
         self._add_raw_message_to_chat(get_string("press_connect_again"))
         self.ws_client.disconnect()
@@ -459,31 +470,66 @@ class GameClientControl(ft.Column):
         self.ready_row.visible = False
         self.ai_response_text.value = ""
         self._update_status_panel(get_string("status_game_start"), ft.Colors.GREEN_700)
-        
-        def fetch_status_and_start_countdown(game_id):
-            try:
-                api_url = f"https://{URL_DOMAIN}/{game_id}/?user_id={self.ws_client.user_id}"
-                response = httpx.get(api_url)
-                response.raise_for_status()
-                game_data = schemes.GameData_Res.model_validate(response.json())
-                self._handle_status(game_data)
-            except Exception as e:
-                self._add_raw_message_to_chat(f"タイマー開始エラー: {e}")
-
-        if self.game_id_input.value:
-            threading.Thread(target=fetch_status_and_start_countdown, args=(self.game_id_input.value,), daemon=True).start()
+        # 終了時刻は直後に届くstatusイベントで受け取り、カウントダウンを始める
         self.update()
 
-    def _handle_status(self, data: schemes.GameData_Res):
+    def _handle_status_event(self, data: schemes.Status):
+        """Applies a status snapshot pushed by the server over the WebSocket."""
+        self.participants = dict(data.users)
+        self._handle_status(data)
+        # seqはユーザー・メッセージの追加ごとに1つ増えるので、表示済みの数より大きければ取りこぼしがある
+        # （参加直前に配信されたメッセージや、送信が詰まって捨てられたメッセージ）
+        if data.seq > max(self.last_seq, len(self.participants) + len(self.shown_messages)):
+            self._sync_missing()
+
+    def _fetch_game_data(self, game_id: str, since: Optional[int] = None) -> schemes.GameData_Res:
+        api_url = f"https://{URL_DOMAIN}/{game_id}/?user_id={self.ws_client.user_id}"
+        if since is not None:
+            api_url += f"&since={since}"
+        response = httpx.get(api_url)
+        response.raise_for_status()
+        return schemes.GameData_Res.model_validate(response.json())
+
+    def _sync_missing(self):
+        """Fetches messages added since the last REST fetch (since=) in a background thread."""
+        if self.syncing or self.game_id is None:
+            return
+        self.syncing = True
+        game_id, since = self.game_id, self.last_seq
+
+        def sync():
+            try:
+                game_data = self._fetch_game_data(game_id, since)
+                # 取得中に別のゲームへ移った場合は反映しない
+                if game_id == self.game_id:
+                    self._apply_game_data(game_data)
+            except (httpx.HTTPError, ValidationError) as exc:
+                print(f"Sync error: {exc}")
+            finally:
+                self.syncing = False
+
+        threading.Thread(target=sync, daemon=True).start()
+
+    def _handle_status(self, data: Union[schemes.GameData_Res, schemes.Status]):
         self.genre_text.value = data.genre or get_string("unassigned")
+        user_id = self.ws_client.user_id
+        if isinstance(data, schemes.Status) and user_id in data.remaining_question:
+            self.question_limit_text.value = get_string("question_limit", count=data.remaining_question[user_id])
+            self.answer_limit_text.value = get_string("answer_limit", count=data.remaining_answering[user_id])
         # ゲームプレイ中はWebSocketからの情報で更新するため、ここでは更新しない
-        if data.status != "playing":
+        elif data.status != "playing":
             self.question_limit_text.value = get_string("question_limit", count=data.question_limit)
             self.answer_limit_text.value = get_string("answer_limit", count=data.ans_limit)
         self.participants_list.controls.clear()
-        for nickname in data.users.values():
+        for nickname in self.participants.values():
             self.participants_list.controls.append(ft.Text(f"- {nickname}"))
 
+        # 進行状態が変わったときだけ操作の可否とステータス表示を切り替える
+        if data.status == self.current_status:
+            self.update()
+            return
+        self.current_status = data.status
+
         if data.status == "playing" and data.end_time:
             self._set_game_controls_enabled(True)
             self.chat_input_row.visible = True
@@ -570,29 +616,21 @@ class GameClientControl(ft.Column):
         self.page.open(dlg) if self.page else None
         self.page.update() if self.page else None
 
-    def _periodic_update_logic(self):
-        """Periodically fetches game data and updates the UI."""
-        while not self.update_stop_event.wait(5):  # Wait for 5 seconds
-            if not self.ws_client.is_connected:
-                break
-            try:
-                game_id = self.game_id_input.value
-                if not game_id: continue
-
-                api_url = f"https://{URL_DOMAIN}/{game_id}/?user_id={self.ws_client.user_id}"
-                response = httpx.get(api_url)
-                response.raise_for_status()
-                game_data = schemes.GameData_Res.model_validate(response.json())
-                
-                if self.page:
-                    self._handle_status(game_data)
-
-            except httpx.HTTPStatusError as exc:
-                # Game might have ended and been removed, stop polling.
-                if exc.response.status_code == 404:
-                    break
-            except Exception as e:
-                print(f"Error during periodic update: {e}")
+    def _reset_game_state(self):
+        self.game_id = None
+        self.last_seq = 0
+        self.current_status = None
+        self.participants.clear()
+        self.shown_messages.clear()
+        self.partial_response = None
+
+    def _apply_game_data(self, data: schemes.GameData_Res):
+        """Applies a full or delta (since=) game state to the UI."""
+        for message in data.messages:
+            self._add_formatted_message(message)
+        self.participants.update(data.users)
+        self.last_seq = max(self.last_seq, data.seq)
+        self._handle_status(data)
 
     # --- Message & Card Builders ---
     def _add_raw_message_to_chat(self, text: str, color: str = ft.Colors.WHITE):
@@ -612,6 +650,12 @@ class GameClientControl(ft.Column):
         else:
             msg_type = msg_data.type
             is_own = msg_data.user == self.ws_client.user_id
+            # WebSocketと差分取得の両方で届いたメッセージは1回だけ表示する
+            message_key = (msg_data.type, msg_data.user, msg_data.time)
+            with self.sync_lock:
+                if message_key in self.shown_messages:
+                    return
+                self.shown_messages.add(message_key)
 
         builder = card_builders.get(msg_type or "")
         if not builder: return
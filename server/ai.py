@@ -1,30 +1,305 @@
 
-from typing import Literal, Optional, Union, TypeVar
-from pydantic import BaseModel, Field
+from typing import Awaitable, Callable, Hashable, Literal, Optional, Union, TypeVar
+from pydantic import BaseModel, Field, ValidationError
 from google import genai
 from google.genai import types
+from google.genai import errors as genai_errors
+import openai
 from openai import AsyncOpenAI
 from openai import pydantic_function_tool
 from openai.types import ResponseFormatText
 from os import environ
 from dotenv import load_dotenv
-import time
+from dataclasses import dataclass
+from collections import Counter, OrderedDict, deque
+import asyncio
+import copy
+import hashlib
+import json
+import random
+
+from cache import TTL_cache
+from normalize import normalize_text
+from theme_cache import Theme_cache
+from partial_json import Partial_json_object
 
 load_dotenv()
 
+# エラーの種類
+Error_class = Literal["rate_limit", "server", "timeout", "validation", "client", "unknown"]
+
+
+# リトライの方針（指数バックオフ＋ジッター）
+@dataclass(frozen=True)
+class Retry_policy:
+    max_attempts: int           # 最大試行回数（初回を含む）
+    base_delay: float = 0.5     # 初回リトライまでの基準待機秒数
+    max_delay: float = 8.0      # 待機秒数の上限
+    multiplier: float = 2.0     # 試行ごとの待機秒数の倍率
+
+    def delay(self, attempt: int) -> float:
+        # Full Jitter: 0〜(基準×倍率^試行回数)の間でランダムに待つ
+        return random.uniform(0, min(self.max_delay, self.base_delay * self.multiplier ** attempt))
+
+
+# エラーの種類ごとのリトライ方針
+DEFAULT_RETRY_POLICIES: dict[Error_class, Retry_policy] = {
+    "rate_limit": Retry_policy(max_attempts=5, base_delay=1.0, max_delay=16.0),
+    "server": Retry_policy(max_attempts=4, base_delay=0.5, max_delay=8.0),
+    "timeout": Retry_policy(max_attempts=3, base_delay=0.5, max_delay=4.0),
+    "validation": Retry_policy(max_attempts=3, base_delay=0.0, max_delay=0.0),
+    "client": Retry_policy(max_attempts=1),
+    "unknown": Retry_policy(max_attempts=3, base_delay=0.5, max_delay=4.0),
+}
+
+
+def classify_error(e: BaseException) -> Error_class:
+    """例外をリトライ方針の種類に分類する"""
+    if isinstance(e, (ValidationError, ValueError)):
+        return "validation"
+    if isinstance(e, (asyncio.TimeoutError, openai.APITimeoutError)):
+        return "timeout"
+    if isinstance(e, openai.APIConnectionError):
+        return "server"
+    if isinstance(e, genai_errors.APIError):
+        status = e.code
+    elif isinstance(e, openai.APIStatusError):
+        status = e.status_code
+    else:
+        return "unknown"
+    if status == 429:
+        return "rate_limit"
+    if status >= 500:
+        return "server"
+    return "client"
+
+
+class Ai_Overloaded(Exception):
+    """AI呼び出しの待ち行列が上限に達し、リクエストを受け付けられない"""
+
+
+# AI呼び出しの同時実行数を制限し、ゲームごとに公平に順番を回す
+class Admission_controller:
+    def __init__(self, max_in_flight: int, max_queue: int):
+        self.max_in_flight = max_in_flight      # 同時に実行できる呼び出し数
+        self.max_queue = max_queue              # 待ち行列の上限（超えたら受け付けない）
+        self.in_flight = 0
+        self.queued = 0
+        # 待ち行列（キー: ゲームID）。先頭のゲームから1件ずつ取り出して末尾に回す
+        self._queues: OrderedDict[Hashable, deque[asyncio.Future[None]]] = OrderedDict()
+        self.counters: Counter[str] = Counter()
+        self.max_queued = 0
+        self.total_wait = 0.0
+
+    async def acquire(self, key: Hashable):
+        if self.in_flight < self.max_in_flight and not self.queued:
+            self.in_flight += 1
+            self.counters["admitted"] += 1
+            return
+        if self.queued >= self.max_queue:
+            self.counters["shed"] += 1
+            raise Ai_Overloaded()
+
+        loop = asyncio.get_running_loop()
+        waiter: asyncio.Future[None] = loop.create_future()
+        self._queues.setdefault(key, deque()).append(waiter)
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        self.counters["waited"] += 1
+        started = loop.time()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 枠を譲り受けた直後にキャンセルされた場合は次へ回す
+                self.release()
+            else:
+                self._discard(key, waiter)
+            raise
+        self.total_wait += loop.time() - started
+        self.counters["admitted"] += 1
+
+    def release(self):
+        # 空いた枠は次のゲームの待機者にそのまま引き渡す
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def _discard(self, key: Hashable, waiter: asyncio.Future[None]):
+        queue = self._queues.get(key)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            self.queued -= 1
+            if not queue:
+                del self._queues[key]
+
+    def stats(self) -> dict[str, int | float | dict[str, int]]:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "max_queue": self.max_queue,
+            "queued_by_game": {str(key): len(queue) for key, queue in self._queues.items()},
+            "average_wait": self.total_wait / self.counters["waited"] if self.counters["waited"] else 0.0,
+            **self.counters,
+        }
+
+
+# 同じ内容のAI呼び出しが実行中なら、新しく呼ばずにその結果を待つ（シングルフライト）
+# 呼び出しは待っている側とは別のタスクで実行するので、最初の呼び出し元がキャンセルされても他の待ち手には結果が届く
+# 待ち手が全員キャンセルされた場合は呼び出しもキャンセルする
+class _Flight:
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0                                        # 結果を待っている呼び出し元の数
+        self.fields: dict = {}                                  # ストリーミングで確定済みのフィールド
+        self.listeners: list[Callable[[dict], None]] = []       # 確定したフィールドを受け取る待ち手
+
+    def emit(self, fields: dict):
+        self.fields.update(fields)
+        for listener in self.listeners:
+            listener(fields)
+
+
+_R = TypeVar("_R")
+
+
+class Single_flight:
+    def __init__(self):
+        self._flights: dict[Hashable, _Flight] = {}
+        self.leaders = 0        # 実際にAIを呼んだ回数
+        self.coalesced = 0      # 実行中の呼び出しに相乗りした回数
+        self.cancelled = 0      # 待ち手がいなくなってキャンセルした回数
+
+    # factoryは確定したフィールドを通知する関数を受け取り、AIを呼ぶコルーチンを返す
+    async def run(
+        self,
+        key: Hashable,
+        factory: Callable[[Callable[[dict], None]], Awaitable[_R]],
+        on_partial: Optional[Callable[[dict], None]] = None,
+    ) -> _R:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(factory(flight.emit))
+            flight.task.add_done_callback(lambda task: self._done(key, flight, task))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+            if on_partial and flight.fields:
+                on_partial(dict(flight.fields))
+        if on_partial:
+            flight.listeners.append(on_partial)
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task) # type: ignore
+        finally:
+            flight.waiters -= 1
+            if on_partial in flight.listeners:
+                flight.listeners.remove(on_partial)
+            # 最後の待ち手がキャンセルされたら、AI呼び出しを止めて同時実行数の枠を空ける
+            if flight.waiters == 0 and not flight.task.done(): # type: ignore
+                flight.task.cancel() # type: ignore
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                self.cancelled += 1
+
+    def _done(self, key: Hashable, flight: _Flight, task: asyncio.Task):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        # 待ち手が全員キャンセルされていても、例外が未取得の警告を出さない
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+        }
+
+
+# トークン数の概算（ASCIIは4文字で1トークン、それ以外は1文字で1トークン程度）
+def estimate_tokens(text: str) -> int:
+    ascii_count = sum(1 for c in text if c.isascii())
+    return ascii_count // 4 + (len(text) - ascii_count)
+
+
+# ゲームの間は変わらないシステムプロンプト
+# 長いものはプロバイダ側のコンテキストキャッシュに載せ、呼び出しごとに全文を送らずに済ませる
+class Game_prompt:
+    def __init__(self, text: str, cache_key: str):
+        self.text = text
+        self.cache_key = cache_key                  # プロバイダに渡すキャッシュのキー（同じプロンプトの呼び出しを同じ所へ送る）
+        self.tokens = estimate_tokens(text)         # トークン数の概算
+        self.cache_task: Optional[asyncio.Task[Optional[str]]] = None   # Geminiのコンテキストキャッシュの作成
+        self.cache_expires = 0.0                    # コンテキストキャッシュの期限（loop.time()）
+
+    def cache_name(self) -> Optional[str]:
+        task = self.cache_task
+        if task is None or not task.done() or task.cancelled() or task.exception():
+            return None
+        return task.result()
+
+
+# ゲームごとのAI呼び出しの文脈（答えを埋め込んだプロンプトをゲームの作成時に1回だけ組み立てる）
+class Game_context:
+    def __init__(self, question: Game_prompt, answer: Game_prompt, answer_batch: Game_prompt):
+        self.question = question
+        self.answer = answer
+        self.answer_batch = answer_batch
+
+    @property
+    def prompts(self) -> list[Game_prompt]:
+        return [self.question, self.answer, self.answer_batch]
+
+
+def _retry_after(e: BaseException) -> Optional[float]:
+    # Retry-Afterヘッダがあればその秒数を返す
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
 class Ai_Agent:
     """Ai_Agentクラスは、単語・人物名当てゲームの判定システムを提供します。このクラスは、ゲームのテーマ判定、質問への回答、ユーザーの回答判定を行うためのメソッドを備えています。
     Attributes:
         ai_type (Literal["gemini", "openai"]): 使用するAIの種類を指定します。
         model (str): 使用するAIモデルの名前を指定します。
         thinking (bool): AIが思考プロセスを出力するかどうかを指定します。
+        retry_stats (Counter): 呼び出し回数・エラーの種類ごとのリトライ回数の集計。
+        question_cache (TTL_cache): 質問への返答のキャッシュ。答えと正規化した質問をキーとします。
+        theme_cache (Theme_cache): お題の検証結果の永続キャッシュ。お題の原文をキーとします。
+        context_stats (Counter): ゲームごとのプロンプトの送信量（概算）・コンテキストキャッシュの利用状況の集計。
+        admission (Admission_controller): AI呼び出しの同時実行数の制限と、ゲームごとに公平な待ち行列。
+            待ち行列が上限を超えた場合はAi_Overloadedを送出します。
     Methods:
+        game_context(answer: str, genre: str, answer_description: str = "", game_id: Optional[int] = None) -> Game_context:
+            ゲームの間変わらない質問・回答判定用のシステムプロンプトを組み立てます。question・answerに渡すと使い回します。
         check_game_thema(answer: str) -> Check_game_thema:
             ゲームの答えとして入力された単語や人物名が利用可能かどうかを判定し、利用可能であればそのジャンルや説明を返します。
-        question(answer: str, question: str, answer_description: str = "") -> Question_schema:
+        question(answer: str, question: str, answer_description: str = "", game_id: Optional[int] = None, context: Optional[Game_context] = None) -> Question_schema:
             ユーザーからの質問に対して、AIが適切な回答を生成します。質問が曖昧または不適切な場合は回答不能とします。
-        answer(answer: str, question: str, answer_description: str = "") -> Answer_schema:
+            同じ答えに対する同じ質問（表記揺れを正規化したもの）はキャッシュから返します。
+        answer(answer: str, question: str, genre: str, answer_description: str = "", game_id: Optional[int] = None, context: Optional[Game_context] = None) -> Answer_schema:
             ユーザーの回答が正解かどうかを判定します。正解の場合は「正解」、不正解の場合は「不正解」を返します。
+        answer_batch(answer: str, questions: list[str], genre: str, answer_description: str = "", game_id: Optional[int] = None, context: Optional[Game_context] = None) -> list[Answer_schema]:
+            複数のユーザーの回答を1回の呼び出しでまとめて判定し、questionsと同じ順番で返します。
     内部クラス:
         Check_game_thema:
             ゲーム開始時の答え判定の返答スキーマを定義します。
@@ -34,6 +309,7 @@ class Ai_Agent:
                 thema (str): ゲームの答え（置き換え済み）。
                 genre (str): 答えのジャンル。
                 description (str): 答えについての説明。
+                aliases (list[str]): 正解として扱える答えの別名・表記揺れ。
         Question_schema:
             質問の返答スキーマを定義します。
             Attributes:
@@ -45,7 +321,11 @@ class Ai_Agent:
             Attributes:
                 thinking (str): 判定における思考プロセス。
                 reply (Literal["正解", "不正解"]): ユーザーの回答が正解かどうか。
-                is_close (bool): ユーザーの質問自体から答えを推測できるかどうか。"""
+                is_close (bool): ユーザーの質問自体から答えを推測できるかどうか。
+        Answer_batch_schema:
+            複数の回答をまとめて判定する返答スキーマを定義します。
+            Attributes:
+                results (list[Answer_batch_item]): 回答ごとの判定結果（入力と同じ順番）。"""
     
     #ゲーム開始時の答え判定の返答スキーマ
     class Check_game_thema(BaseModel):
@@ -53,6 +333,35 @@ class Ai_Agent:
         thema:str = Field(description="2. ゲームの答え（置き換え済み）")
         genre:str = Field(description="3. 答えのジャンル（「[thema]は[genre]です」という文が成り立つように）")
         description:str = Field(description="4. 答えについての説明")
+        aliases:list[str] = Field(description="5. 正解として扱える答えの別名・表記揺れ（ひらがな・カタカナ・英語表記・ローマ字・略称など）")
+
+    #ゲーム開始時の答え判定のプロンプト
+    CHECK_GAME_THEMA_PROMPT = """あなたは単語・人物名当てゲームの判定システムです。
+        これから単語当てクイズを始めるにあたり、ゲームを開始するユーザーがゲームの答えとなる単語・人物名を入力します。
+        1. あなたは、その入力を答えとして利用可能かどうか判定してください
+        判定基準：
+            1. 入力が意味不明・曖昧ではないこと：
+                ・「ゾンビ」や「ドラゴン」など、汎用的なキャラクターは不可
+            2. 次のいずれかに該当すること：
+        　      ・1つの明確な意味を持つ単語である
+        　      ・著名な実在の人物
+                ・特定の作品における架空のキャラクター名である
+            3. 人物名やキャラクター名の場合：
+                ・人物名などの場合において、考えうる人物が複数いる場合、より広く知られている人物とする。
+        
+        2. 答えとして利用可能である場合、上記の条件に従いもっとも一般的、もしくは正式な名称に置き換えてください。
+            ・作品に登場する答えの場合、その作品名を括弧でくくって補足してください。
+
+        3. 利用可能である場合、ヒントとなるようその答えのジャンルを出力してください。（人物、架空のキャラクター、動物、4文字熟語、映画、歌、○○学、ゲームなど）
+            ・「[thema]は[genre]です。」という文が成り立つ必要があります。
+        
+        4. 答えについて、それが何かを誰でも分かるように説明をしてください。
+
+        5. ユーザーが回答として入力したときに正解とできる、答えの別名・表記揺れを列挙してください。
+            ・ひらがな・カタカナ表記、英語表記、ローマ字表記、一般的な略称や通称など
+            ・上位概念や、答え以外のものも指しうる語は含めないでください。
+        """
+    CHECK_GAME_THEMA_ORDERING = ["is_useable","thema","genre","description","aliases"]
 
     #質問の返答スキーマ
     class Question_schema(BaseModel):
@@ -65,10 +374,54 @@ class Ai_Agent:
         is_correct: bool = Field(description="ユーザーの回答が正解かどうか")
         is_close: bool = Field(description="ユーザーの質問自体から答えを推測できるかどうか")
 
-    def __init__(self, type:Literal["gemini","openai"], model: str, thinking:bool = True):
+    #まとめて判定する回答の返答スキーマ
+    class Answer_batch_item(BaseModel):
+        answer: str = Field(description="判定したユーザーの回答（入力のまま）")
+        is_correct: bool = Field(description="ユーザーの回答が正解かどうか")
+        is_close: bool = Field(description="ユーザーの質問自体から答えを推測できるかどうか")
+
+    class Answer_batch_schema(BaseModel):
+        results: list["Ai_Agent.Answer_batch_item"] = Field(description="回答ごとの判定結果（入力と同じ順番・同じ数）")
+
+    def __init__(
+        self,
+        type:Literal["gemini","openai"],
+        model: str,
+        thinking:bool = True,
+        deadline: float = 60.0,
+        attempt_timeout: float = 30.0,
+        retry_policies: Optional[dict[Error_class, Retry_policy]] = None,
+        question_cache_size: int = 4096,
+        question_cache_ttl: Optional[float] = 6 * 60 * 60,
+        max_in_flight: int = 8,
+        max_queue: int = 64,
+        theme_cache_path: Optional[str] = "data/theme_cache.jsonl",
+        stream: bool = True,
+        context_cache_min_tokens: int = 1024,
+        context_cache_ttl: float = 60 * 60,
+    ):
         self.ai_type = type
         self.model = model
         self.thinking = thinking
+        self.deadline = deadline                    # 1回の呼び出し（リトライ込み）の制限時間
+        self.attempt_timeout = attempt_timeout      # 1回の試行の制限時間
+        self.retry_policies = {**DEFAULT_RETRY_POLICIES, **(retry_policies or {})}
+        self.retry_stats: Counter[str] = Counter()  # 呼び出し・リトライ回数の集計
+        # 質問への返答キャッシュ（キー: (答え, 正規化した質問)）
+        self.question_cache: TTL_cache[tuple[str, str], Ai_Agent.Question_schema] = TTL_cache(
+            maxsize=question_cache_size, ttl=question_cache_ttl
+        )
+        self.admission = Admission_controller(max_in_flight=max_in_flight, max_queue=max_queue)
+        self.stream = stream                        # 質問への返答をストリーミングで受け取り、replyが確定した時点で通知する
+        self.single_flight = Single_flight()        # 同じ内容の同時呼び出しをまとめる
+        # この概算トークン数以上のゲームのプロンプトはGeminiのコンテキストキャッシュに載せる（Geminiの最小トークン数に合わせる）
+        self.context_cache_min_tokens = context_cache_min_tokens
+        self.context_cache_ttl = context_cache_ttl  # コンテキストキャッシュの有効期間（秒）
+        self.context_stats: Counter[str] = Counter()
+        # お題の検証結果の永続キャッシュ（プロンプト・モデルが変わると無効になる）
+        self.theme_cache: Optional[Theme_cache] = (
+            Theme_cache(theme_cache_path, self.check_game_thema_fingerprint()) if theme_cache_path else None
+        )
         match self.ai_type:
             case "gemini":
                 self.gemini_client = genai.Client(api_key = environ["gemini_key"])
@@ -79,91 +432,247 @@ class Ai_Agent:
             case _:
                 raise ValueError("geminiまたはopenaiを入力してください")
     
+    # お題の検証結果に影響する設定（AIの種類・モデル・プロンプト・スキーマ）の指紋
+    def check_game_thema_fingerprint(self) -> str:
+        source = json.dumps([
+            self.ai_type,
+            self.model,
+            self.CHECK_GAME_THEMA_PROMPT,
+            self.CHECK_GAME_THEMA_ORDERING,
+            self.Check_game_thema.model_json_schema(),
+        ], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+    # スキーマごとのJSONスキーマ（model_json_schema()は重いので、クラス全体で1回だけ作る）
+    # SDKが渡した辞書を書き換えることがあるので、呼び出し元にはコピーを返す
+    _json_schemas: dict[tuple[type[BaseModel], tuple[str, ...]], dict] = {}
+
+    @classmethod
+    def json_schema(cls, schema: type[BaseModel], propertyOrdering: list) -> dict:
+        key = (schema, tuple(propertyOrdering))
+        json_schema = cls._json_schemas.get(key)
+        if json_schema is None:
+            json_schema = cls._json_schemas[key] = {**schema.model_json_schema(), "propertyOrdering": list(propertyOrdering)}
+        return copy.deepcopy(json_schema)
+
     T = TypeVar("T", bound=BaseModel)
-    async def _generate(self, schema:type[T], system_prompt:str, text:str, propertyOrdering:list) -> T:
-        json_schema = schema.model_json_schema()
-        json_schema["propertyOrdering"] = propertyOrdering
-        
-        for attempt in range(3):
+    # on_partialを指定するとストリーミングで受け取り、値が確定したフィールドを順に渡す
+    async def _generate(
+        self,
+        schema:type[T],
+        system_prompt:str | Game_prompt,
+        text:str,
+        propertyOrdering:list,
+        key:Hashable = None,
+        on_partial: Optional[Callable[[dict], None]] = None,
+    ) -> T:
+        json_schema = self.json_schema(schema, propertyOrdering)
+        if isinstance(system_prompt, Game_prompt):
+            self.context_stats["calls"] += 1
+            self.context_stats["prompt_tokens_estimated"] += system_prompt.tokens
+
+        # リトライ待機はasyncio.sleepで行い、イベントループを止めない
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        attempts: Counter[Error_class] = Counter()
+        self.retry_stats["calls"] += 1
+        while True:
             try:
-                match self.ai_type:
-                    case "gemini":
-                        response = await self.gemini_client.aio.models.generate_content(
-                            model = self.model,
-                            contents = text,
-                            config = types.GenerateContentConfig(
-                                response_schema = json_schema,
-                                response_mime_type="application/json",
-                                system_instruction=system_prompt,
-                                temperature=0.1,
-                                #tools=[types.Tool(google_search=types.GoogleSearch())],
-                                thinking_config=types.ThinkingConfig(
-                                    thinking_budget=512
-                                )
-                            )
-                        )
-                        return schema.model_validate_json(response.text or "{}")
-                    
-                    case "openai":
-                        json_schema["additionalProperties"] = False
-                        response = await self.openai_client.chat.completions.create(
-                            model = self.model,
-                            messages = [
-                                {"role":"system", "content":system_prompt},
-                                {"role": "user", "content":text}
-                            ],
-                            verbosity="low",
-                            reasoning_effort="minimal",
-                            #temperature = 0.1,
-                            response_format = {
-                                "type":"json_schema",
-                                "json_schema":{
-                                    "name":json_schema["title"],
-                                    "strict":True,
-                                    "schema":json_schema
-                                }
-                            }
-                        )
-                        return schema.model_validate_json(response.choices[0].message.content or "{}")
-                    case _:
-                        raise ValueError()
+                # 同時実行数の枠が空くまで待つ（待ち行列が一杯ならAi_Overloaded）
+                await asyncio.wait_for(self.admission.acquire(key), timeout=deadline - loop.time())
+                try:
+                    return await asyncio.wait_for(
+                        self._request(schema, json_schema, system_prompt, text, on_partial),
+                        timeout=min(self.attempt_timeout, deadline - loop.time()),
+                    )
+                finally:
+                    self.admission.release()
+            except Ai_Overloaded:
+                raise
             except Exception as e:
-                print(f"Attempt {attempt + 1} failed: {e}")
-                last_exception = e
-                time.sleep(1)
-        raise last_exception or RuntimeError("Unknown error occurred in _generate method.")
-    
-    async def check_game_thema(self, answer:str) -> Check_game_thema:
-        system_prompt = """あなたは単語・人物名当てゲームの判定システムです。
-        これから単語当てクイズを始めるにあたり、ゲームを開始するユーザーがゲームの答えとなる単語・人物名を入力します。
-        1. あなたは、その入力を答えとして利用可能かどうか判定してください
-        判定基準：
-            1. 入力が意味不明・曖昧ではないこと：
-                ・「ゾンビ」や「ドラゴン」など、汎用的なキャラクターは不可
-            2. 次のいずれかに該当すること：
-        　      ・1つの明確な意味を持つ単語である
-        　      ・著名な実在の人物
-                ・特定の作品における架空のキャラクター名である
-            3. 人物名やキャラクター名の場合：
-                ・人物名などの場合において、考えうる人物が複数いる場合、より広く知られている人物とする。
-        
-        2. 答えとして利用可能である場合、上記の条件に従いもっとも一般的、もしくは正式な名称に置き換えてください。
-            ・作品に登場する答えの場合、その作品名を括弧でくくって補足してください。
+                error_class = classify_error(e)
+                attempts[error_class] += 1
+                policy = self.retry_policies[error_class]
+                print(f"Attempt {attempts.total()} failed ({error_class}): {e!r}")
+                if attempts[error_class] >= policy.max_attempts:
+                    self.retry_stats["failures"] += 1
+                    raise
+                delay = _retry_after(e) or policy.delay(attempts[error_class] - 1)
+                if loop.time() + delay >= deadline:
+                    self.retry_stats["deadline_exceeded"] += 1
+                    raise
+                self.retry_stats["retries"] += 1
+                self.retry_stats[f"retry_{error_class}"] += 1
+                await asyncio.sleep(delay)
 
-        3. 利用可能である場合、ヒントとなるようその答えのジャンルを出力してください。（人物、架空のキャラクター、動物、4文字熟語、映画、歌、○○学、ゲームなど）
-            ・「[thema]は[genre]です。」という文が成り立つ必要があります。
-        
-        4. 答えについて、それが何かを誰でも分かるように説明をしてください。
-        """
-        
-        schema = self.Check_game_thema.model_json_schema()
-        print("生成開始",flush=True)
-        response = await self._generate(self.Check_game_thema, system_prompt, answer, ["is_useable","thema","genre"])
-        print(response,flush=True)
-        return response
+    # プロバイダへ1回だけリクエストする
+    async def _request(
+        self,
+        schema:type[T],
+        json_schema:dict,
+        system_prompt:str | Game_prompt,
+        text:str,
+        on_partial: Optional[Callable[[dict], None]] = None,
+    ) -> T:
+        prompt = system_prompt if isinstance(system_prompt, Game_prompt) else None
+        if prompt is not None:
+            system_prompt = prompt.text
+        match self.ai_type:
+            case "gemini":
+                # コンテキストキャッシュに載せたプロンプトは、全文の代わりにキャッシュ名を送る
+                cached_content = await self._context_cache(prompt) if prompt else None
+                if cached_content:
+                    self.context_stats["cached_calls"] += 1
+                params = dict(
+                    model = self.model,
+                    contents = text,
+                    config = types.GenerateContentConfig(
+                        response_schema = json_schema,
+                        response_mime_type="application/json",
+                        system_instruction=None if cached_content else system_prompt,
+                        cached_content=cached_content,
+                        temperature=0.1,
+                        #tools=[types.Tool(google_search=types.GoogleSearch())],
+                        thinking_config=types.ThinkingConfig(
+                            thinking_budget=512
+                        )
+                    )
+                )
+                if on_partial is None:
+                    response = await self.gemini_client.aio.models.generate_content(**params)
+                    self._record_gemini_usage(response.usage_metadata)
+                    return schema.model_validate_json(response.text or "{}")
+                parser = Partial_json_object()
+                usage = None
+                async for chunk in await self.gemini_client.aio.models.generate_content_stream(**params):
+                    usage = chunk.usage_metadata or usage
+                    if chunk.text and (fields := parser.feed(chunk.text)):
+                        on_partial(fields)
+                self._record_gemini_usage(usage)
+                return schema.model_validate_json(parser.buffer or "{}")
+            
+            case "openai":
+                # strictモードでは入れ子のオブジェクトにもadditionalPropertiesの指定が要る
+                json_schema = {**json_schema, "additionalProperties": False}
+                if "$defs" in json_schema:
+                    json_schema["$defs"] = {
+                        name: {**definition, "additionalProperties": False}
+                        for name, definition in json_schema["$defs"].items()
+                    }
+                params = dict(
+                    model = self.model,
+                    messages = [
+                        {"role":"system", "content":system_prompt},
+                        {"role": "user", "content":text}
+                    ],
+                    verbosity="low",
+                    reasoning_effort="minimal",
+                    #temperature = 0.1,
+                    response_format = {
+                        "type":"json_schema",
+                        "json_schema":{
+                            "name":json_schema["title"],
+                            "strict":True,
+                            "schema":json_schema
+                        }
+                    }
+                )
+                if prompt is not None:
+                    # 同じゲームのプロンプトを同じ所へ送り、プロンプトキャッシュに当たりやすくする
+                    params["prompt_cache_key"] = prompt.cache_key
+                if on_partial is None:
+                    response = await self.openai_client.chat.completions.create(**params)
+                    self._record_openai_usage(response.usage)
+                    return schema.model_validate_json(response.choices[0].message.content or "{}")
+                parser = Partial_json_object()
+                async for chunk in await self.openai_client.chat.completions.create(**params, stream=True, stream_options={"include_usage": True}):
+                    self._record_openai_usage(chunk.usage)
+                    content = chunk.choices[0].delta.content if chunk.choices else None
+                    if content and (fields := parser.feed(content)):
+                        on_partial(fields)
+                return schema.model_validate_json(parser.buffer or "{}")
+            case _:
+                raise ValueError()
     
-    async def question(self, answer:str, question:str, answer_description:str = "") -> Question_schema:
-        system_prompt = f"""あなたは単語・人物名当てゲームの判定システムです。
+    # プロバイダが返した入力トークン数のうち、キャッシュから読まれた分を集計する
+    def _record_gemini_usage(self, usage: Optional[types.GenerateContentResponseUsageMetadata]):
+        if usage is None:
+            return
+        self.context_stats["provider_prompt_tokens"] += usage.prompt_token_count or 0
+        self.context_stats["provider_cached_tokens"] += usage.cached_content_token_count or 0
+
+    def _record_openai_usage(self, usage):
+        if usage is None:
+            return
+        self.context_stats["provider_prompt_tokens"] += usage.prompt_tokens or 0
+        details = usage.prompt_tokens_details
+        self.context_stats["provider_cached_tokens"] += (details.cached_tokens or 0) if details else 0
+
+    # Geminiのコンテキストキャッシュの名前を返す。短いプロンプトや作成に失敗した場合はNone（全文を送る）
+    async def _context_cache(self, prompt: Game_prompt) -> Optional[str]:
+        if prompt.tokens < self.context_cache_min_tokens:
+            return None
+        loop = asyncio.get_running_loop()
+        if prompt.cache_task is None or (prompt.cache_task.done() and loop.time() >= prompt.cache_expires):
+            # 期限の少し前に作り直す
+            prompt.cache_expires = loop.time() + self.context_cache_ttl * 0.9
+            prompt.cache_task = asyncio.create_task(self._create_context_cache(prompt))
+        return await asyncio.shield(prompt.cache_task)
+
+    async def _create_context_cache(self, prompt: Game_prompt) -> Optional[str]:
+        try:
+            cache = await self.gemini_client.aio.caches.create(
+                model=self.model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=prompt.text,
+                    display_name=prompt.cache_key,
+                    ttl=f"{int(self.context_cache_ttl)}s",
+                ),
+            )
+        except Exception as e:
+            print(f"コンテキストキャッシュの作成に失敗：{e!r}")
+            self.context_stats["cache_failures"] += 1
+            return None
+        self.context_stats["caches_created"] += 1
+        return cache.name
+
+    # ゲームの破棄時に、作成したコンテキストキャッシュを消す
+    async def release_context(self, context: Game_context):
+        for prompt in context.prompts:
+            name = prompt.cache_name()
+            prompt.cache_task = None
+            if name is None:
+                continue
+            try:
+                await self.gemini_client.aio.caches.delete(name=name)
+                self.context_stats["caches_deleted"] += 1
+            except Exception as e:
+                print(f"コンテキストキャッシュの削除に失敗：{e!r}")
+
+    def context_cache_stats(self) -> dict:
+        calls = self.context_stats["calls"]
+        prompt_tokens = self.context_stats["provider_prompt_tokens"]
+        return {
+            "min_tokens": self.context_cache_min_tokens,
+            "ttl": self.context_cache_ttl,
+            **self.context_stats,
+            "average_prompt_tokens_estimated": round(self.context_stats["prompt_tokens_estimated"] / calls, 1) if calls else 0.0,
+            "provider_cached_rate": round(self.context_stats["provider_cached_tokens"] / prompt_tokens, 3) if prompt_tokens else 0.0,
+        }
+
+    # ゲームの間変わらないプロンプトを組み立てる（Game_dataの作成時に1回だけ呼ぶ）
+    def game_context(self, answer:str, genre:str, answer_description:str = "", game_id:Optional[int] = None) -> Game_context:
+        self.context_stats["contexts"] += 1
+        key = f"game-{game_id}" if game_id is not None else f"answer-{hashlib.sha256(answer.encode('utf-8')).hexdigest()[:16]}"
+        answer_prompt = self._answer_prompt(answer, genre, answer_description)
+        return Game_context(
+            question=Game_prompt(self._question_prompt(answer, answer_description), f"{key}-question"),
+            answer=Game_prompt(answer_prompt, f"{key}-answer"),
+            answer_batch=Game_prompt(answer_prompt + self.ANSWER_BATCH_PROMPT, f"{key}-answer-batch"),
+        )
+
+    def _question_prompt(self, answer:str, answer_description:str) -> str:
+        return f"""あなたは単語・人物名当てゲームの判定システムです。
         ユーザーは答えについて質問をするので、回答してください。
         このゲームの答え：「{answer}」
         答えについての説明：「{answer_description}」
@@ -177,14 +686,15 @@ class Ai_Agent:
             3. 最初の文字は〇ですか？など文字から当てようとしている質問の場合。
             4. あなたが質問に対する答えを知らない場合。"""
 
-        response = await self._generate(self.Question_schema,system_prompt,question,["reply","include_answer"])
-        print(response)
-        validated = self.Question_schema.model_validate(response)
+    # 回答の判定プロンプトの後ろに付け、複数の回答をまとめて判定させる
+    ANSWER_BATCH_PROMPT = """
+        # 複数の回答の判定
+        ・ユーザーの回答は、複数人分がJSONの文字列の配列で与えられます。
+        ・それぞれの回答を独立に上の基準で判定し、resultsに入力と同じ順番・同じ数で返してください。
+        """
 
-        return validated
-    
-    async def answer(self, answer:str, question:str, genre:str, answer_description:str = "") -> Answer_schema:
-        system_prompt = f"""あなたは単語・人物名当てゲームの判定システムです。
+    def _answer_prompt(self, answer:str, genre:str, answer_description:str) -> str:
+        return f"""あなたは単語・人物名当てゲームの判定システムです。
         このゲームの答え：「{answer}」
         ユーザーに与えられているジャンル情報：「{genre}」
         答えについての説明：「{answer_description}」
@@ -194,6 +704,140 @@ class Ai_Agent:
         ・ユーザーの回答が、正解のカテゴリを包含するような上位概念（抽象的、広義の語）の場合、不正解とします。
         ただしジャンル内で、一般的にそれが答えのみを指す通称として用いられる場合は正解とします。
         """
-        response = await self._generate(self.Answer_schema, system_prompt, question, ["is_correct", "is_close"])
+
+    async def check_game_thema(self, answer:str) -> Check_game_thema:
+        # 検証済みのお題はAIを呼ばずに保存済みの結果を返す
+        if self.theme_cache is not None:
+            cached = self.theme_cache.get(answer)
+            if cached is not None:
+                return self.Check_game_thema.model_validate(cached)
+
+        return await self.single_flight.run(("check_game_thema", answer), lambda emit: self._check_game_thema(answer))
+
+    async def _check_game_thema(self, answer:str) -> Check_game_thema:
+        system_prompt = self.CHECK_GAME_THEMA_PROMPT
+        
+        print("生成開始",flush=True)
+        response = await self._generate(self.Check_game_thema, system_prompt, answer, self.CHECK_GAME_THEMA_ORDERING)
+        print(response,flush=True)
+        if self.theme_cache is not None:
+            self.theme_cache.set(answer, response.model_dump())
+        return response
+    
+    # on_replyを指定すると、ストリーミングでreplyが確定した時点で呼ばれる（キャッシュから返す場合は呼ばれない）
+    # contextを指定すると、ゲームの作成時に組み立てたプロンプトを使い回す
+    async def question(
+        self,
+        answer:str,
+        question:str,
+        answer_description:str = "",
+        game_id:Optional[int] = None,
+        on_reply: Optional[Callable[[str], None]] = None,
+        context: Optional[Game_context] = None,
+    ) -> Question_schema:
+        # 同じ答えに対する同じ質問はモデルを呼ばずにキャッシュから返す
+        cache_key = (answer, normalize_text(question))
+        cached = self.question_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        on_partial = None
+        if on_reply is not None:
+            def on_partial(fields: dict):
+                if isinstance(fields.get("reply"), str):
+                    on_reply(fields["reply"])
+
+        # 同じ質問が実行中ならその結果を待つ（返答の一言も共有する）
+        return await self.single_flight.run(
+            ("question", *cache_key),
+            lambda emit: self._question(
+                context.question if context else self._question_prompt(answer, answer_description),
+                question, game_id, cache_key, emit,
+            ),
+            on_partial,
+        )
+
+    async def _question(
+        self,
+        system_prompt:str | Game_prompt,
+        question:str,
+        game_id:Optional[int],
+        cache_key:tuple[str, str],
+        emit:Callable[[dict], None],
+    ) -> Question_schema:
+        response = await self._generate(
+            self.Question_schema, system_prompt, question, ["reply","include_answer"],
+            key=game_id, on_partial=emit if self.stream else None,
+        )
+        print(response)
+        validated = self.Question_schema.model_validate(response)
+        self.question_cache.set(cache_key, validated)
+
+        return validated
+    
+    async def answer(
+        self,
+        answer:str,
+        question:str,
+        genre:str,
+        answer_description:str = "",
+        game_id:Optional[int] = None,
+        context: Optional[Game_context] = None,
+    ) -> Answer_schema:
+        # 同じ回答の判定が実行中ならその結果を待つ
+        return await self.single_flight.run(
+            ("answer", answer, normalize_text(question)),
+            lambda emit: self._answer(
+                context.answer if context else self._answer_prompt(answer, genre, answer_description),
+                question, game_id,
+            ),
+        )
+
+    async def _answer(self, system_prompt:str | Game_prompt, question:str, game_id:Optional[int]) -> Answer_schema:
+        response = await self._generate(self.Answer_schema, system_prompt, question, ["is_correct", "is_close"], key=game_id)
         print(response)
         return self.Answer_schema.model_validate(response)
+
+    # 複数の回答を1回の呼び出しでまとめて判定する
+    # 結果の数や、結果に添えられた回答が入力と合わない場合は、1件ずつの判定に切り替える
+    async def answer_batch(
+        self,
+        answer:str,
+        questions:list[str],
+        genre:str,
+        answer_description:str = "",
+        game_id:Optional[int] = None,
+        context: Optional[Game_context] = None,
+    ) -> list[Answer_schema]:
+        # 表記揺れだけの同じ回答は1つにまとめて判定する
+        unique: dict[str, str] = {}
+        for question in questions:
+            unique.setdefault(normalize_text(question), question)
+        if len(unique) == 1:
+            res = await self.answer(answer, questions[0], genre, answer_description, game_id, context)
+            return [res] * len(questions)
+
+        guesses = list(unique.values())
+        self.retry_stats["batch_calls"] += 1
+        response = await self._generate(
+            self.Answer_batch_schema,
+            context.answer_batch if context else self._answer_prompt(answer, genre, answer_description) + self.ANSWER_BATCH_PROMPT,
+            json.dumps(guesses, ensure_ascii=False),
+            ["results"],
+            key=game_id,
+        )
+        print(response)
+        if len(response.results) == len(guesses) and all(
+            normalize_text(item.answer) == key for key, item in zip(unique, response.results)
+        ):
+            verdicts = {
+                key: self.Answer_schema(is_correct=item.is_correct, is_close=item.is_close)
+                for key, item in zip(unique, response.results)
+            }
+        else:
+            self.retry_stats["batch_fallbacks"] += 1
+            results = await asyncio.gather(*(
+                self.answer(answer, guess, genre, answer_description, game_id, context) for guess in guesses
+            ))
+            verdicts = dict(zip(unique, results))
+        return [verdicts[normalize_text(question)] for question in questions]
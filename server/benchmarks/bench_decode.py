@@ -0,0 +1,49 @@
+"""WebSocketフレームのデコード速度のベンチマーク
+
+typeで振り分けるTypeAdapterと、以前の通常のUnion（先頭から順に検証）を比較します。
+    cd server && python benchmarks/bench_decode.py
+"""
+import json
+import os
+import sys
+import timeit
+import uuid
+from typing import Union
+
+from pydantic import BaseModel
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import schemes
+
+NUMBER = 20_000
+
+
+# 以前の判別子なしのUnion
+class Legacy_WSEvent(BaseModel):
+    root: Union[
+        schemes.Ready, schemes.Result, schemes.JoinDeclare, schemes.Question, schemes.Answer, schemes.Event,
+        schemes.Res_Question, schemes.Res_Answer, schemes.NewGame_Redirect, schemes.Status, schemes.Response,
+    ]
+
+
+def main():
+    user = str(uuid.uuid4())
+    frames = {
+        "join_declare": {"type": "join_declare", "user": user, "is_player": True, "nickname": "player"},
+        "ready": {"type": "ready", "user": user},
+        "question": {"type": "question", "user": user, "text": "生き物ですか？"},
+        "answer": {"type": "answer", "user": user, "text": "ピカチュウ"},
+    }
+    print(f"{'type':<14}{'before':>10}{'after':>10}{'speedup':>9}")
+    for name, frame in frames.items():
+        text = json.dumps(frame, ensure_ascii=False)
+        # 以前の経路: receive_json() → WSEvent.model_validate({"root": msg})
+        before = timeit.timeit(lambda: Legacy_WSEvent.model_validate({"root": json.loads(text)}), number=NUMBER)
+        # 現在の経路: receive_text() → ws_event_adapter.validate_json(msg)
+        after = timeit.timeit(lambda: schemes.ws_event_adapter.validate_json(text), number=NUMBER)
+        print(f"{name:<14}{before / NUMBER * 1e6:>8.2f}us{after / NUMBER * 1e6:>8.2f}us{before / after:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""ゲーム状態のメモリ使用量のベンチマーク
+
+pydanticモデルで持っていた場合と、__slots__つきのdataclassで持つ場合を比較します。
+    cd server && python benchmarks/bench_memory.py
+"""
+import datetime
+import os
+import sys
+import timeit
+import tracemalloc
+import uuid
+from typing import Callable, Optional
+
+from pydantic import BaseModel
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import schemes
+from game_manager import TZ, Question_record, User_data
+
+USERS = 1_000
+MESSAGES = 50_000
+
+
+# 以前のpydantic版のユーザーデータ
+class Pydantic_user(BaseModel):
+    user_id: uuid.UUID
+    is_player: bool
+    nickname: str
+    remaining_answering: int
+    remaining_question: int
+    answered_correctly: bool = False
+    is_ready: bool = False
+    answered_at: Optional[datetime.datetime] = None
+
+
+def measure(build: Callable[[], list]) -> int:
+    tracemalloc.start()
+    objects = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def make_users(cls) -> list:
+    return [
+        cls(user_id=uuid.uuid4(), is_player=True, nickname=f"player{i}", remaining_answering=3, remaining_question=10)
+        for i in range(USERS)
+    ]
+
+
+def main():
+    now = datetime.datetime.now(TZ)
+    users = make_users(User_data)
+
+    def pydantic_messages() -> list:
+        return [
+            schemes.Res_Question(
+                time=now, user=users[i % USERS].user_id, nickname=users[i % USERS].nickname,
+                include_answer=False, title="はい", question=f"質問{i}", reply="そうです", remaining_count=3,
+            )
+            for i in range(MESSAGES)
+        ]
+
+    def slotted_messages() -> list:
+        return [
+            Question_record(
+                time=now, user=users[i % USERS], include_answer=False,
+                title="はい", question=f"質問{i}", reply="そうです", remaining_count=3,
+            )
+            for i in range(MESSAGES)
+        ]
+
+    rows = [
+        (f"users x{USERS}", measure(lambda: make_users(Pydantic_user)), measure(lambda: make_users(User_data))),
+        (f"messages x{MESSAGES}", measure(pydantic_messages), measure(slotted_messages)),
+    ]
+    print(f"{'':<18}{'pydantic':>14}{'slots':>14}{'saved':>8}")
+    for name, before, after in rows:
+        print(f"{name:<18}{before / 1024:>11.0f}KiB{after / 1024:>11.0f}KiB{1 - after / before:>8.0%}")
+
+    # remaining_question -= 1 の速度
+    pydantic_user = make_users(Pydantic_user)[0]
+    slotted_user = users[0]
+
+    def decrement(user):
+        user.remaining_question -= 1
+
+    number = 200_000
+    before = timeit.timeit(lambda: decrement(pydantic_user), number=number)
+    after = timeit.timeit(lambda: decrement(slotted_user), number=number)
+    print(f"{'decrement':<18}{before / number * 1e9:>12.0f}ns{after / number * 1e9:>12.0f}ns{1 - after / before:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import asyncio
+import base64
+from collections import deque
+from typing import Callable, Optional, TYPE_CHECKING
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+if TYPE_CHECKING:
+    from state_backend import State_backend
+
+# 送信キューが溢れたときに古いものから捨ててよいイベント（チャットと、後続で上書きされる状態通知）
+DROPPABLE_TYPES = frozenset({"res_question", "res_answer", "status"})
+
+
+# コネクションごとの送信タスクと上限つきの送信キュー
+class Connection_writer:
+    def __init__(
+        self,
+        ws: WebSocket,
+        maxsize: int,
+        send_timeout: float,
+        on_dead: Callable[[WebSocket], None],
+        encoding: str = "json",
+    ):
+        self.ws = ws
+        self.encoding = encoding            # "json" またはschemes.COMPACT_ENCODING
+        self.maxsize = maxsize              # 送信キューの上限
+        self.send_timeout = send_timeout    # 1フレームの送信を待つ秒数
+        self._on_dead = on_dead             # 送信に失敗したときに呼ばれる
+        self._queue: deque[tuple[str | bytes, bool]] = deque()  # (フレーム, 捨ててよいか)
+        self._ready = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.task = asyncio.create_task(self._run())
+
+    def put(self, frame: str | bytes, droppable: bool):
+        if len(self._queue) >= self.maxsize:
+            # 一番古いチャットイベントを捨てる。なければ新しいチャットイベントを捨てる
+            # 結果発表やリダイレクトなど捨てられないイベントは上限を超えても積む
+            for i, (_, queued_droppable) in enumerate(self._queue):
+                if queued_droppable:
+                    del self._queue[i]
+                    self.dropped += 1
+                    break
+            else:
+                if droppable:
+                    self.dropped += 1
+                    return
+        self._queue.append((frame, droppable))
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._ready.set()
+
+    async def _run(self):
+        try:
+            while True:
+                while not self._queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                frame, droppable = self._queue.popleft()
+                if isinstance(self.ws, Remote_socket):
+                    # 捨ててよいかどうかは中継先のワーカーの送信キューで使う
+                    send = self.ws.forward(frame, droppable)
+                elif isinstance(frame, bytes):
+                    send = self.ws.send_bytes(frame)
+                else:
+                    send = self.ws.send_text(frame)
+                await asyncio.wait_for(send, timeout=self.send_timeout)
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"{self.ws.client}への送信に失敗：{e!r}")
+            # 遅い・切断済みのクライアントは閉じて、再接続させる
+            try:
+                await asyncio.wait_for(self.ws.close(code=1011), timeout=1)
+            except Exception:
+                pass
+            self._on_dead(self.ws)
+
+    def close(self):
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "client": str(self.ws.client),
+            "encoding": self.encoding,
+            "depth": len(self._queue),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
+
+
+# 他のワーカーが受け付けたWebSocketの代わりにオーナーのワーカーで使うオブジェクト
+# 送信は状態バックエンド経由で受け付けたワーカーに届け、受信はそのワーカーから転送されたものを受け取る
+class Remote_socket:
+    def __init__(self, backend: "State_backend", conn_id: str, origin: str, client: str, query_params: dict[str, str]):
+        self.backend = backend
+        self.conn_id = conn_id
+        self.origin = origin                # WebSocketを受け付けたワーカーのID
+        self.client = client
+        self.query_params = query_params
+        self._inbox: asyncio.Queue[Optional[str]] = asyncio.Queue()
+
+    async def accept(self):
+        pass
+
+    async def receive_text(self) -> str:
+        text = await self._inbox.get()
+        if text is None:
+            raise WebSocketDisconnect()
+        return text
+
+    # 受け付けたワーカーから届いた受信内容。Noneは切断
+    def feed(self, text: Optional[str]):
+        self._inbox.put_nowait(text)
+
+    async def forward(self, frame: str | bytes, droppable: bool):
+        message = {"kind": "send", "conn": self.conn_id, "droppable": droppable}
+        if isinstance(frame, bytes):
+            message["bytes"] = base64.b64encode(frame).decode()
+        else:
+            message["text"] = frame
+        self.backend.publish(self.origin, message)
+
+    async def send_text(self, text: str):
+        await self.forward(text, False)
+
+    async def close(self, code: int = 1000, reason: Optional[str] = None):
+        self.backend.publish(self.origin, {"kind": "close", "conn": self.conn_id, "code": code})
+        self.feed(None)
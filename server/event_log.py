@@ -0,0 +1,212 @@
+import asyncio
+import json
+import os
+import re
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterator, Optional
+
+# イベントログのファイル名（世代ごとに分ける）
+_EVENTS_RE = re.compile(r"^events\.(\d+)\.jsonl$")
+
+
+# ゲームの作成・参加・質問・回答・状態変化を追記するイベントログ
+# 追記はSTATUS_COALESCE_DELAYと同じようにflush_intervalだけ待ってまとめて書き込み、
+# fsync_intervalに応じてfsyncする（0なら書き込みごと、Noneならしない）
+# ログがcompact_bytesを超えたら全ゲームのスナップショットを書き、古い世代のログを消す
+# ファイルへの書き込み・fsync・スナップショットの保存は専用のスレッド1本で順番に行い、イベントループを止めない
+class Event_log:
+    def __init__(
+        self,
+        directory: str,
+        flush_interval: float = 0.05,
+        fsync_interval: Optional[float] = 0.0,
+        compact_bytes: int = 8 * 1024 * 1024,
+    ):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.compact_bytes = compact_bytes
+        self.snapshot_path = os.path.join(directory, "snapshot.json")
+        self.generation = 0                 # 書き込み中のログの世代
+        self._file = None                   # スレッドからだけ触る
+        self._buffer: list[str] = []
+        self._flush_pending = False
+        self._fsynced_at = 0.0
+        self._bytes = 0                     # 前回のスナップショット以降に書き込んだバイト数
+        self._snapshot: Optional[Callable[[], list[dict]]] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.pending_writes = 0             # スレッドでの反映待ちの書き込み
+        self.stats_counts = {"appended": 0, "flushes": 0, "fsyncs": 0, "compactions": 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def _events_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"events.{generation:08d}.jsonl")
+
+    def _generations(self) -> list[int]:
+        return sorted(
+            int(m.group(1)) for name in os.listdir(self.directory)
+            if (m := _EVENTS_RE.match(name))
+        )
+
+    # スナップショットのゲームと、その後のイベントを返す
+    def load(self) -> tuple[list[dict], Iterator[dict]]:
+        generation, games = 0, []
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            generation, games = data["generation"], data["games"]
+        generations = [g for g in self._generations() if g >= generation]
+        self.generation = max([generation, *generations])
+        return games, self._read_events(generations)
+
+    def _read_events(self, generations: list[int]) -> Iterator[dict]:
+        for generation in generations:
+            with open(self._events_path(generation), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # 書き込み途中で止まった最後の行
+                        print(f"[event_log] skipped broken line in generation {generation}")
+
+    # 新しい世代のログを開いて追記を始める（途中で切れたかもしれない前の世代には追記しない）
+    def open(self, snapshot: Callable[[], list[dict]]):
+        self._snapshot = snapshot
+        self.generation += 1
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="event_log")
+        self._submit(self._open_file, self.generation)
+
+    def _submit(self, fn: Callable, *args):
+        assert self._executor is not None
+        self.pending_writes += 1
+        self._executor.submit(fn, *args).add_done_callback(self._written)
+
+    def _written(self, future: Future):
+        self.pending_writes -= 1
+        if future.exception():
+            print(f"[event_log] write failed: {future.exception()!r}")
+
+    def _open_file(self, generation: int):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self._events_path(generation), "a", encoding="utf-8")
+
+    def append(self, event: dict):
+        if self._executor is None:
+            return
+        self._buffer.append(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.stats_counts["appended"] += 1
+        if not self._flush_pending:
+            self._flush_pending = True
+            asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        self._flush_pending = False
+        if self._executor is None or not self._buffer:
+            return
+        data = "".join(self._buffer)
+        self._buffer.clear()
+        self._bytes += len(data)
+        self._submit(self._write, data)
+        if self._bytes >= self.compact_bytes:
+            self.compact()
+
+    def _write(self, data: str):
+        assert self._file is not None
+        self._file.write(data)
+        self._file.flush()
+        self.stats_counts["flushes"] += 1
+        now = time.monotonic()
+        if self.fsync_interval is not None and now - self._fsynced_at >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._fsynced_at = now
+            self.stats_counts["fsyncs"] += 1
+
+    # 全ゲームのスナップショットを書き、それより前の世代のログを消す
+    # スナップショットの内容はこの時点で集め、保存はスレッドで行う（以降の追記は新しい世代に入る）
+    def compact(self):
+        if self._executor is None or self._snapshot is None:
+            return
+        self.flush()
+        self.generation += 1
+        self._bytes = 0
+        self._submit(self._compact, self.generation, self._snapshot())
+
+    def _compact(self, generation: int, games: list[dict]):
+        self._open_file(generation)
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"generation": generation, "games": games}, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        for old in self._generations():
+            if old < generation:
+                os.remove(self._events_path(old))
+        self.stats_counts["compactions"] += 1
+
+    def _close_file(self):
+        if self._file is None:
+            return
+        if self.fsync_interval is not None:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def close(self):
+        if self._executor is None:
+            return
+        self.flush()
+        self._submit(self._close_file)
+        # 反映待ちの書き込みを終えてから止める
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "generation": self.generation,
+            "bytes_since_snapshot": self._bytes,
+            "buffered": len(self._buffer),
+            "pending_writes": self.pending_writes,
+            **self.stats_counts,
+        }
+
+
+# EVENT_LOG_DIR・EVENT_LOG_FSYNC環境変数の値からイベントログを作る
+# directoryが"none"なら記録しない。fsyncはfsyncする間隔（秒）で、"none"ならfsyncしない
+# router.pyでワーカーを分ける場合は、ワーカーごとに別のディレクトリを使う
+# 状態を共有するバックエンドでuvicorn --workersを使う場合は、空いているworker_N（ロックで確保）を使う
+def create_event_log(directory: str, fsync: str = "0", worker_url: Optional[str] = None, shared: bool = False) -> Optional[Event_log]:
+    if directory == "none":
+        return None
+    if worker_url:
+        directory = os.path.join(directory, re.sub(r"\W+", "_", worker_url))
+    elif shared:
+        directory = _claim_worker_directory(directory)
+    return Event_log(directory, fsync_interval=None if fsync == "none" else float(fsync))
+
+
+# 他のプロセスがロックしていないworker_Nディレクトリを確保する
+# ロックはプロセスが終わるまで持ち続け、再起動後は同じ番号から順に確保し直して前回のログを引き継ぐ
+_worker_locks: list = []
+
+def _claim_worker_directory(directory: str) -> str:
+    try:
+        import fcntl
+    except ImportError:
+        raise RuntimeError("状態を共有するバックエンドでイベントログを使うにはWORKER_URLを指定するか、EVENT_LOG_DIR=noneにしてください")
+    n = 0
+    while True:
+        path = os.path.join(directory, f"worker_{n}")
+        os.makedirs(path, exist_ok=True)
+        lock = open(os.path.join(path, "lock"), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            n += 1
+            continue
+        _worker_locks.append(lock)
+        return path
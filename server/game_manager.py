@@ -1,23 +1,74 @@
 import asyncio
 import datetime
-from typing import Optional, TYPE_CHECKING, Literal
+import time
+from typing import Awaitable, Callable, Coroutine, Optional, TYPE_CHECKING, Literal
 import uuid
 import random
+import re
+import bisect
 import json
+import base64
+import os
+from collections import Counter, deque
 from fastapi import HTTPException
-from fastapi import WebSocket
-from pydantic import BaseModel
+from fastapi import WebSocket, WebSocketDisconnect
+from dataclasses import dataclass
 
 import schemes
-from ai import Ai_Agent
+from ai import Ai_Agent, Game_context
+from connection import Connection_writer, Remote_socket, DROPPABLE_TYPES
+from state_backend import State_backend, Memory_backend
+from event_log import Event_log
+from resources import File_resource, Theme_entry, parse_themes
+from normalize import normalize_text, romaji_to_hiragana, fold_long_vowels, edit_distance
 
 if TYPE_CHECKING:
     from .game_manager import GameManager
 
 TZ = datetime.timezone(datetime.timedelta(hours=9))
 
+# 「答え（作品名）」の補足部分
+_PAREN_RE = re.compile(r"[（(][^（()）]*[)）]")
+# 状態通知をまとめて送るまでの待ち時間（秒）
+STATUS_COALESCE_DELAY = 0.05
+# 編集距離で「惜しい」とみなす最小の文字数と許容距離（アフリカとアメリカのように別物もあるので正解にはしない）
+PREJUDGE_MIN_LENGTH = 4
+PREJUDGE_MAX_DISTANCE = 1
+# 次のゲームの作成を試す回数と、やり直すまでの待ち時間（秒、回数に比例して延ばす）
+NEXT_GAME_ATTEMPTS = 3
+NEXT_GAME_RETRY_DELAY = 5.0
+
+
+def judge_keys(text: str) -> set[str]:
+    """回答の比較に使うキー（正規化・ローマ字のかな化をしたもの）を返す"""
+    keys = set()
+    for variant in (text, _PAREN_RE.sub("", text)):
+        key = normalize_text(variant)
+        if not key:
+            continue
+        keys.add(key)
+        kana = romaji_to_hiragana(key)
+        if kana:
+            keys.add(kana)
+    return keys
+
+
+def romaji_keys(text: str) -> set[str]:
+    """ローマ字の回答をかなにして長音を除いたキーを返す（tokyoとtoukyouを同一視する）
+
+    かなで書かれた回答には使わない（「ゆうき」と「ゆき」のように別の語になるため）
+    """
+    keys = set()
+    for variant in (text, _PAREN_RE.sub("", text)):
+        kana = romaji_to_hiragana(normalize_text(variant))
+        if kana:
+            keys.add(fold_long_vowels(kana))
+    return keys
+
 # ユーザーデータ
-class User_data(BaseModel):
+# ゲーム中に頻繁に書き換えるため、pydanticではなく__slots__つきのdataclassで持つ
+@dataclass(slots=True)
+class User_data:
     user_id: uuid.UUID
     is_player: bool
     nickname: str
@@ -28,14 +79,216 @@ class User_data(BaseModel):
     answered_at: Optional[datetime.datetime] = None
 
 
+# 質問の履歴（送信時にschemes.Res_Questionへ変換する）
+@dataclass(slots=True)
+class Question_record:
+    time: datetime.datetime
+    user: User_data
+    include_answer: bool
+    title: str
+    question: str
+    reply: str
+    remaining_count: int
+
+    def to_scheme(self) -> schemes.Res_Question:
+        return schemes.Res_Question(
+            time=self.time,
+            user=self.user.user_id,
+            nickname=self.user.nickname,
+            include_answer=self.include_answer,
+            title=self.title,
+            question=self.question,
+            reply=self.reply,
+            remaining_count=self.remaining_count,
+        )
+
+
+# 回答の履歴（送信時にschemes.Res_Answerへ変換する）
+@dataclass(slots=True)
+class Answer_record:
+    time: datetime.datetime
+    user: User_data
+    judge: bool
+    include_answer: bool
+    answer: str
+    remaining_count: int
+
+    def to_scheme(self) -> schemes.Res_Answer:
+        return schemes.Res_Answer(
+            time=self.time,
+            user=self.user.user_id,
+            nickname=self.user.nickname,
+            judge=self.judge,
+            include_answer=self.include_answer,
+            answer=self.answer,
+            remaining_count=self.remaining_count,
+        )
+
+
+# 直近size件の所要時間（秒）を保持し、平均・パーセンタイルを出す
+class Latency_recorder:
+    def __init__(self, size: int = 1000):
+        self.samples: deque[float] = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def stats(self) -> dict:
+        if not self.samples:
+            return {"count": self.count}
+        ordered = sorted(self.samples)
+        return {
+            "count": self.count,
+            "average": round(sum(ordered) / len(ordered), 4),
+            "p50": round(ordered[len(ordered) // 2], 4),
+            "p95": round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)], 4),
+            "max": round(ordered[-1], 4),
+        }
+
+
+# 短い間に届いた回答をまとめて1回のAI呼び出しで判定し、結果をそれぞれの呼び出し元に返す
+# 最初の回答からwindow秒待つか、max_size件たまった時点で判定を始める
+class Answer_batcher:
+    def __init__(
+        self,
+        judge: Callable[[list[str]], Awaitable[list[Ai_Agent.Answer_schema]]],
+        window: float,
+        max_size: int,
+        stats: Counter[str],
+    ):
+        self.judge = judge
+        self.window = window
+        self.max_size = max_size
+        self.stats = stats      # GameManagerの集計（全ゲーム共通）
+        self._pending: list[tuple[str, asyncio.Future[Ai_Agent.Answer_schema]]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()      # 実行中の判定（参照を持っておかないと途中で回収されることがある）
+
+    async def run(self, answer: str) -> Ai_Agent.Answer_schema:
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[Ai_Agent.Answer_schema] = loop.create_future()
+        self._pending.append((answer, future))
+        if len(self._pending) >= self.max_size:
+            self.stats["flushed_by_size"] += 1
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._judge(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _judge(self, batch: list[tuple[str, asyncio.Future[Ai_Agent.Answer_schema]]]):
+        # 待っている間にキャンセルされた回答は判定しない
+        batch = [(answer, future) for answer, future in batch if not future.done()]
+        if not batch:
+            return
+        self.stats["batches"] += 1
+        self.stats["answers"] += len(batch)
+        self.stats["max_size"] = max(self.stats["max_size"], len(batch))
+        try:
+            results = await self.judge([answer for answer, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+# 実行中のAI呼び出しを追跡し、結果発表前に待ち合わせる
+class In_flight_tracker:
+    def __init__(self):
+        self.tasks: set[asyncio.Task] = set()
+        self._idle = asyncio.Event()        # 実行中の呼び出しがないときにセットされる
+        self._idle.set()
+        self.cancelled: int = 0             # 待ち合わせの期限切れでキャンセルした数
+
+    async def run(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        self._idle.clear()
+        task.add_done_callback(self._discard)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            current = asyncio.current_task()
+            # 呼び出し元ではなくwait()の期限切れでキャンセルされた場合
+            if task.cancelled() and not (current and current.cancelling()):
+                raise asyncio.TimeoutError("AIの処理が時間内に終わりませんでした")
+            raise
+
+    def _discard(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not self.tasks:
+            self._idle.set()
+
+    # すべての呼び出しが終わるまで待つ。期限を過ぎたら残りをキャンセルしてFalseを返す
+    async def wait(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            remaining = list(self.tasks)
+            for task in remaining:
+                task.cancel()
+            self.cancelled += len(remaining)
+            await asyncio.gather(*remaining, return_exceptions=True)
+            return False
+
+
+# 記録（イベントログ・スナップショット）から履歴を復元する
+def record_from_dict(data: dict, user: User_data) -> Question_record | Answer_record:
+    time = datetime.datetime.fromisoformat(data["time"])
+    if data["type"] == "res_question":
+        return Question_record(
+            time=time,
+            user=user,
+            include_answer=data["include_answer"],
+            title=data["title"],
+            question=data["question"],
+            reply=data["reply"],
+            remaining_count=data["remaining_count"],
+        )
+    return Answer_record(
+        time=time,
+        user=user,
+        judge=data["judge"],
+        include_answer=data["include_answer"],
+        answer=data["answer"],
+        remaining_count=data["remaining_count"],
+    )
+
+
+def _isoformat(value: Optional[datetime.datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def _fromisoformat(value: Optional[str]) -> Optional[datetime.datetime]:
+    return datetime.datetime.fromisoformat(value) if value else None
+
+
 # ゲーム
 class Game_data:
     def __init__(
         self,
         game_id: int,
+        room_id: int,
         answer: str,
         genre: str,
         answer_description: str,
+        answer_aliases: list[str],
         user: uuid.UUID,
         question_limit: int,
         ans_limit: int,
@@ -45,9 +298,18 @@ class Game_data:
         initial_post_data: schemes.NewGame_Post,
     ):
         self.game_id: int = game_id
+        self.room_id: int = room_id                         # ルームID（続けて遊ぶゲームは同じルームになる）
         self.answer: str = answer                           # ゲームの答え
         self.genre: str = genre                             # 答えのジャンル
         self.answer_description: str = answer_description   # 答えの詳細な説明
+        self.answer_aliases: list[str] = answer_aliases     # 答えの別名
+        self.answer_keys: set[str] = set().union(           # 正解とみなす回答の比較キー（答え・別名）
+            *(judge_keys(text) for text in [answer, *answer_aliases])
+        )
+        self.answer_romaji_keys: set[str] = set().union(    # ローマ字の答え・別名の長音を除いたキー
+            *(romaji_keys(text) for text in [answer, *answer_aliases])
+        )
+        self.answer_verdicts: dict[str, Ai_Agent.Answer_schema] = {}  # 判定済みの回答（キー: 正規化した回答）
         self.user: uuid.UUID = user                         # ゲームを作成したユーザーのID
         self.question_limit: int = question_limit           # プレイヤー1人あたりの質問回数上限
         self.ans_limit: int = ans_limit                     # プレイヤー1人あたりの回答回数上限
@@ -56,28 +318,53 @@ class Game_data:
         self.end_time: Optional[datetime.datetime] = None         # ゲームの終了時刻
         
         self.ai_agent = ai_agent                            # ゲームロジックを処理するAIエージェントのインスタンス
+        self.ai_context: Game_context = ai_agent.game_context(  # 答えを埋め込んだ質問・回答判定用のプロンプト
+            answer, genre, answer_description, game_id
+        )
         self.timer_task: Optional[asyncio.Task] = None      # 制限時間を管理する非同期タスク
         
         self.users: dict[uuid.UUID, User_data] = {}         # ゲームに参加しているユーザーデータの辞書 (キー: user_id)
         self.connections: dict[WebSocket, Optional[uuid.UUID]] = {}          # 現在接続中のWebSocketコネクションのセット
+        self.writers: dict[WebSocket, Connection_writer] = {}               # コネクションごとの送信タスク
         self.state: Literal["waiting", "playing", "finished", "redirected"] = "waiting"  # ゲームの進行状態
-        self.messages: list[schemes.Res_Answer | schemes.Res_Question] = []  # ゲーム中にやりとりされた質問と回答の履歴
+        self.messages: list[Question_record | Answer_record] = []  # ゲーム中にやりとりされた質問と回答の履歴
         self.correct_answerer: list[User_data] = []         # 正解したユーザーのリスト
+        self.seq: int = 0                                   # メッセージ・ユーザーの追加ごとに増えるシーケンス番号
+        self.message_seqs: list[int] = []                   # messagesの各要素が追加されたときのシーケンス番号
+        self.user_seqs: dict[uuid.UUID, int] = {}           # ユーザーが追加されたときのシーケンス番号
+        self._status_pending: bool = False                  # 状態通知の送信待ち
+        self.interner = schemes.User_interner()             # コンパクトエンコーディング用のuser_idの番号付け
         self.game_manager = game_manager                    # 親となるGameManagerのインスタンス
         self.initial_post_data = initial_post_data          # ゲーム作成時の初期設定データ
         self.manual_next_answer: Optional[str] = None       # 手動で設定された次ゲームのお題
-        self.new_game_id:        Optional[int]
-        self.pending_ai_answers: int = 0
+        self.new_game_id:        Optional[int] = None
+        self.finished_at: Optional[float] = None            # ゲームが終了した時刻（time.monotonic）
+        self.in_flight = In_flight_tracker()                # 実行中のAIの質問・回答判定
+        self.answer_batcher = Answer_batcher(               # 同時に届いた回答のまとめ判定
+            self._judge_answers,
+            window=game_manager.answer_batch_window,
+            max_size=game_manager.answer_batch_size,
+            stats=game_manager.answer_batch_stats,
+        )
+
+        # ゲーム終了判定用に差分で更新するカウンタ
+        self._connection_counts: Counter[uuid.UUID] = Counter()  # ユーザーごとの接続数
+        self.connected_players: int = 0                    # 接続中のプレイヤー数
+        self.finished_players: int = 0                      # 接続中のプレイヤーのうち、正解済みか回答権を使い切った人数
+        self._end_event = asyncio.Event()                   # 制限時間前にゲームを終了させるイベント
 
     @classmethod
     async def __aio_init__(
         cls,
         game_id: int,
+        room_id: int,
         post_data: schemes.NewGame_Post,
         ai_agent: Ai_Agent,
         game_manager: "GameManager",
+        checked: Optional[Ai_Agent.Check_game_thema] = None,
     ) -> "Game_data":
-        res = await ai_agent.check_game_thema(post_data.answer)
+        # 検証済みのお題が渡された場合はAIを呼ばない
+        res = checked or await ai_agent.check_game_thema(post_data.answer)
         if not res.is_useable:
             raise HTTPException(400)
         answer = res.thema
@@ -86,9 +373,11 @@ class Game_data:
 
         return cls(
             game_id=game_id,
+            room_id=room_id,
             answer=answer,
             genre=genre,
             answer_description=answer_description,
+            answer_aliases=res.aliases,
             user=post_data.user,
             question_limit=post_data.question_limit,
             ans_limit=post_data.ans_limit,
@@ -102,78 +391,500 @@ class Game_data:
         if len(self.users) > 0 and all(self.users[user_uuid].is_ready for user_uuid in self.connections.values() if user_uuid):
             await self.start_game()
 
-    # ゲームのタイマー
-    async def game_timer(self, time: int):
+    # ゲームのタイマー（制限時間まで待つか、終了条件を満たした時点で終了する）
+    async def game_timer(self, time: float):
         try:
-            # 毎秒判定して待機する
-            for _ in range(time):
-                # 接続中のプレイヤーが1人以上いて、かつ全員が正解済みか詰みの場合
-                connected_user_ids = {uid for uid in self.connections.values() if uid is not None}
-                connected_players = [
-                    user
-                    for user_id, user in self.users.items()
-                    if user.is_player and user_id in connected_user_ids
-                ]
-
-                if len(connected_players) > 0 and all(
-                    p.answered_correctly or p.remaining_answering == 0
-                    for p in connected_players
-                ):
-                    await self.game_over()
-                    return
-                
-                await asyncio.sleep(1)
+            self._check_completion()
+            try:
+                await asyncio.wait_for(self._end_event.wait(), timeout=time)
+            except asyncio.TimeoutError:
+                pass
             await self.game_over()
 
         except asyncio.CancelledError:
             return
 
+    @staticmethod
+    def _is_finished(user: User_data) -> bool:
+        return user.answered_correctly or user.remaining_answering == 0
+
+    # 接続中のプレイヤーが1人以上いて、かつ全員が正解済みか詰みの場合はゲームを終了させる
+    def _check_completion(self):
+        if (
+            self.state == "playing"
+            and self.connected_players > 0
+            and self.finished_players == self.connected_players
+        ):
+            self._end_event.set()
+
+    def add_user(self, user: User_data):
+        self._insert_user(user)
+        self.game_manager.log_event({
+            "type": "join",
+            "game_id": self.game_id,
+            "user": [str(user.user_id), user.nickname, user.is_player, user.remaining_answering, user.remaining_question],
+        })
+        # コンパクトエンコーディングの接続には、番号の対応表を先に送る
+        frame = schemes.encode_intern([self.interner.intern(user.user_id, user.nickname)])
+        for writer in self.writers.values():
+            if writer.encoding == schemes.COMPACT_ENCODING:
+                writer.put(frame, droppable=False)
+        self.notify_status()
+
+    def _insert_user(self, user: User_data):
+        self.seq += 1
+        self.users[user.user_id] = user
+        self.user_seqs[user.user_id] = self.seq
+
+    def mark_ready(self, user: User_data):
+        user.is_ready = True
+        self.game_manager.log_event({"type": "ready", "game_id": self.game_id, "user": str(user.user_id)})
+
+    # 質問権を1つ消費する
+    def record_question(self, user: User_data):
+        user.remaining_question -= 1
+        self.notify_status()
+
+    def status_event(self) -> schemes.Status:
+        return schemes.Status(
+            seq=self.seq,
+            status=self.state,
+            genre=self.genre,
+            ans_limit=self.ans_limit,
+            question_limit=self.question_limit,
+            start_time=self.start_time,
+            end_time=self.end_time,
+            users={uid: user.nickname for uid, user in self.users.items()},
+            remaining_question={uid: user.remaining_question for uid, user in self.users.items() if user.is_player},
+            remaining_answering={uid: user.remaining_answering for uid, user in self.users.items() if user.is_player},
+        )
+
+    # 状態の変化を通知する。短時間に続いた変化は1回の通知にまとめる
+    def notify_status(self):
+        if self._status_pending:
+            return
+        self._status_pending = True
+        asyncio.get_running_loop().call_later(STATUS_COALESCE_DELAY, self._flush_status)
+
+    def _flush_status(self):
+        self._status_pending = False
+        self.broadcast(schemes.WSEvent(root=self.status_event()))
+        self.game_manager.save_game(self)
+
+    def set_state(self, state: Literal["waiting", "playing", "finished", "redirected"]):
+        self._apply_state(state)
+        self.game_manager.log_event({
+            "type": "state",
+            "game_id": self.game_id,
+            "state": state,
+            "start_time": _isoformat(self.start_time),
+            "end_time": _isoformat(self.end_time),
+            "new_game_id": self.new_game_id,
+        })
+        self.notify_status()
+
+    def _apply_state(self, state: Literal["waiting", "playing", "finished", "redirected"]):
+        self.state = state
+        if state in ("finished", "redirected") and self.finished_at is None:
+            self.finished_at = time.monotonic()
+
+    # ゲーム一覧に表示する要約
+    def summary(self) -> dict:
+        return {
+            "status": self.state,
+            "answer": self.answer,
+            "connection_count": len(self.connections),
+        }
+
+    # sinceを指定された場合は、それ以降に追加されたメッセージ・ユーザーだけを返す
+    def to_scheme(self, since: Optional[int] = None) -> schemes.GameData_Res:
+        if since is not None:
+            messages = self.messages_since(since)
+            users = self.users_since(since)
+        else:
+            messages = self.messages
+            users = self.users
+        return schemes.GameData_Res(
+            seq=self.seq,
+            messages=[message.to_scheme() for message in messages],
+            genre=self.genre,
+            ans_limit=self.ans_limit,
+            question_limit=self.question_limit,
+            start_time=self.start_time,
+            end_time=self.end_time,
+            status=self.state,
+            users={uid: user.nickname for uid, user in users.items()},
+        )
+
+    # 次のゲームのお題を手動で指定する
+    def set_next_answer(self, answer: str):
+        self.manual_next_answer = answer
+        self.game_manager.log_event({"type": "next_answer", "game_id": self.game_id, "answer": answer})
+        if self.state == "finished":
+            self.set_state("redirected")
+
+    # 再起動後に復元するための全状態
+    def snapshot(self) -> dict:
+        return {
+            "game_id": self.game_id,
+            "room_id": self.room_id,
+            "answer": self.answer,
+            "genre": self.genre,
+            "description": self.answer_description,
+            "aliases": self.answer_aliases,
+            # パスワードは/new_gameでしか使わないので、ディスクに残さない
+            "post_data": self.initial_post_data.model_dump(mode="json", exclude={"password"}),
+            "state": self.state,
+            "start_time": _isoformat(self.start_time),
+            "end_time": _isoformat(self.end_time),
+            "seq": self.seq,
+            "new_game_id": self.new_game_id,
+            "manual_next_answer": self.manual_next_answer,
+            "users": [
+                [
+                    str(user.user_id), user.nickname, user.is_player, user.remaining_answering, user.remaining_question,
+                    user.answered_correctly, user.is_ready, _isoformat(user.answered_at), self.user_seqs[user.user_id],
+                ]
+                for user in self.users.values()
+            ],
+            "messages": [
+                [seq, message.to_scheme().model_dump(mode="json", exclude={"nickname"})]
+                for seq, message in zip(self.message_seqs, self.messages)
+            ],
+            "correct_answerer": [str(user.user_id) for user in self.correct_answerer],
+        }
+
+    @classmethod
+    def from_snapshot(cls, data: dict, ai_agent: Ai_Agent, game_manager: "GameManager") -> "Game_data":
+        post_data = schemes.NewGame_Post.model_validate({**data["post_data"], "password": ""})
+        game = cls(
+            game_id=data["game_id"],
+            room_id=data["room_id"],
+            answer=data["answer"],
+            genre=data["genre"],
+            answer_description=data["description"],
+            answer_aliases=data["aliases"],
+            user=post_data.user,
+            question_limit=post_data.question_limit,
+            ans_limit=post_data.ans_limit,
+            time_limit=post_data.time_limit,
+            ai_agent=ai_agent,
+            game_manager=game_manager,
+            initial_post_data=post_data,
+        )
+        game._apply_state(data["state"])
+        game.start_time = _fromisoformat(data["start_time"])
+        game.end_time = _fromisoformat(data["end_time"])
+        game.new_game_id = data["new_game_id"]
+        game.manual_next_answer = data["manual_next_answer"]
+        users: dict[str, User_data] = {}   # 文字列のuser_idから引く（UUIDへの変換を1回で済ませる）
+        for user_id, nickname, is_player, remaining_answering, remaining_question, answered_correctly, is_ready, answered_at, seq in data["users"]:
+            user = users[user_id] = User_data(
+                user_id=uuid.UUID(user_id),
+                is_player=is_player,
+                nickname=nickname,
+                remaining_answering=remaining_answering,
+                remaining_question=remaining_question,
+                answered_correctly=answered_correctly,
+                is_ready=is_ready,
+                answered_at=_fromisoformat(answered_at),
+            )
+            game.users[user.user_id] = user
+            game.user_seqs[user.user_id] = seq
+            game.interner.intern(user.user_id, nickname)
+        for seq, message in data["messages"]:
+            game.messages.append(record_from_dict(message, users[message["user"]]))
+            game.message_seqs.append(seq)
+        game.correct_answerer = [users[user_id] for user_id in data["correct_answerer"]]
+        game.seq = data["seq"]
+        return game
+
+    # イベントログの1件を反映する（再起動時の復元用。配信やログへの記録はしない）
+    def apply_event(self, event: dict):
+        kind = event["type"]
+        if kind == "join":
+            user_id, nickname, is_player, remaining_answering, remaining_question = event["user"]
+            self._insert_user(User_data(
+                user_id=uuid.UUID(user_id),
+                is_player=is_player,
+                nickname=nickname,
+                remaining_answering=remaining_answering,
+                remaining_question=remaining_question,
+            ))
+            self.interner.intern(uuid.UUID(user_id), nickname)
+        elif kind == "ready":
+            self.users[uuid.UUID(event["user"])].is_ready = True
+        elif kind == "message":
+            user = self.users[uuid.UUID(event["message"]["user"])]
+            message = record_from_dict(event["message"], user)
+            if isinstance(message, Question_record):
+                user.remaining_question = message.remaining_count
+            else:
+                user.remaining_answering = message.remaining_count
+                if message.judge:
+                    user.answered_correctly = True
+                    user.answered_at = _fromisoformat(event["answered_at"])
+                    self.correct_answerer.append(user)
+            self.seq += 1
+            self.messages.append(message)
+            self.message_seqs.append(self.seq)
+        elif kind == "state":
+            self._apply_state(event["state"])
+            self.start_time = _fromisoformat(event["start_time"])
+            self.end_time = _fromisoformat(event["end_time"])
+            self.new_game_id = event["new_game_id"]
+        elif kind == "next_answer":
+            self.manual_next_answer = event["answer"]
+
+    # 復元したゲームのタイマーを再開する
+    def resume(self):
+        if self.state == "playing" and self.end_time:
+            remaining = (self.end_time - datetime.datetime.now(TZ)).total_seconds()
+            self.timer_task = asyncio.create_task(self.game_timer(max(remaining, 0)))
+        elif self.state == "finished":
+            # 結果発表の途中で止まったゲームは、結果発表と次のゲームの作成をやり直す
+            self.timer_task = asyncio.create_task(self.game_timer(0))
+
+    # アーカイブ用のコンパクトな記録
+    def archive_record(self) -> dict:
+        return {
+            "game_id": self.game_id,
+            "room_id": self.room_id,
+            "answer": self.answer,
+            "genre": self.genre,
+            "state": self.state,
+            "start_time": self.start_time.isoformat() if self.start_time else None,
+            "end_time": self.end_time.isoformat() if self.end_time else None,
+            "new_game_id": self.new_game_id,
+            "users": [
+                [str(user.user_id), user.nickname, user.is_player, user.answered_at.isoformat() if user.answered_at else None]
+                for user in self.users.values()
+            ],
+            "messages": [message.to_scheme().model_dump(mode="json", exclude={"nickname"}) for message in self.messages],
+        }
+
+    # 履歴に追加して配信する
+    def append_message(self, message: Question_record | Answer_record):
+        self.seq += 1
+        self.messages.append(message)
+        self.message_seqs.append(self.seq)
+        scheme = message.to_scheme()
+        self.game_manager.log_event({
+            "type": "message",
+            "game_id": self.game_id,
+            "message": scheme.model_dump(mode="json", exclude={"nickname"}),
+            "answered_at": _isoformat(message.user.answered_at),
+        })
+        self.broadcast(schemes.WSEvent(root=scheme))
+        self.game_manager.save_game(self)
+
+    # シーケンス番号sinceより後に追加されたメッセージ
+    def messages_since(self, since: int) -> list[Question_record | Answer_record]:
+        return self.messages[bisect.bisect_right(self.message_seqs, since):]
+
+    # シーケンス番号sinceより後に追加されたユーザー
+    def users_since(self, since: int) -> dict[uuid.UUID, User_data]:
+        return {uid: self.users[uid] for uid, seq in self.user_seqs.items() if seq > since}
+
+    def add_connection(self, ws: WebSocket, encoding: str = "json"):
+        self.connections[ws] = None
+        writer = Connection_writer(
+            ws,
+            maxsize=self.game_manager.send_queue_size,
+            send_timeout=self.game_manager.send_timeout,
+            on_dead=self.remove_connection,
+            encoding=encoding,
+        )
+        self.writers[ws] = writer
+        if encoding == schemes.COMPACT_ENCODING and self.interner.entries:
+            writer.put(schemes.encode_intern(self.interner.entries), droppable=False)
+
+    # コネクションとユーザーを紐付ける
+    def bind_connection(self, ws: WebSocket, user_id: uuid.UUID):
+        if self.connections.get(ws) == user_id:
+            return
+        self._unbind(ws)
+        self.connections[ws] = user_id
+        self._connection_counts[user_id] += 1
+        user = self.users[user_id]
+        if self._connection_counts[user_id] == 1 and user.is_player:
+            self.connected_players += 1
+            self.finished_players += self._is_finished(user)
+        self._check_completion()
+
+    def remove_connection(self, ws: WebSocket):
+        if ws not in self.connections:
+            return
+        self._unbind(ws)
+        del self.connections[ws]
+        writer = self.writers.pop(ws, None)
+        if writer:
+            writer.close()
+        self._check_completion()
+
+    def _unbind(self, ws: WebSocket):
+        user_id = self.connections.get(ws)
+        if user_id is None:
+            return
+        self.connections[ws] = None
+        self._connection_counts[user_id] -= 1
+        if self._connection_counts[user_id] > 0:
+            return
+        del self._connection_counts[user_id]
+        user = self.users[user_id]
+        if user.is_player:
+            self.connected_players -= 1
+            self.finished_players -= self._is_finished(user)
+
+    # 回答の判定結果をユーザーに反映する
+    def record_answer(self, user: User_data, is_correct: bool, answered_at: datetime.datetime):
+        was_finished = self._is_finished(user)
+        if is_correct:
+            user.answered_correctly = True
+            user.answered_at = answered_at
+            self.correct_answerer.append(user)
+        user.remaining_answering -= 1
+        self.notify_status()
+        if not was_finished and self._is_finished(user) and user.is_player and user.user_id in self._connection_counts:
+            self.finished_players += 1
+        self._check_completion()
+
     async def start_game(self):
-        self.state = "playing"
         self.start_time = datetime.datetime.now(TZ)
         self.end_time = self.start_time + self.time_limit
-        self.timer_task = asyncio.create_task(self.game_timer(int(self.time_limit.total_seconds())))
-        await self.broadcast(schemes.WSEvent(root=schemes.Event(type="game_start")))
+        self.set_state("playing")
+        self.timer_task = asyncio.create_task(self.game_timer(self.time_limit.total_seconds()))
+        self.broadcast(schemes.WSEvent(root=schemes.Event(type="game_start")))
 
-    async def ai_question(self, question: str):
-        return await self.ai_agent.question(
+    # on_replyには、返答の一言（reply）が確定した時点で1回だけ渡す
+    async def ai_question(self, question: str, on_reply: Optional[Callable[[str], None]] = None):
+        latency = self.game_manager.question_latency
+        started = time.perf_counter()
+        replied = False
+
+        def first_reply(reply: str):
+            nonlocal replied
+            if replied:
+                return
+            replied = True
+            latency["first_feedback"].add(time.perf_counter() - started)
+            if on_reply:
+                on_reply(reply)
+
+        res = await self.in_flight.run(self.ai_agent.question(
             answer=self.answer,
             question=question,
             answer_description=self.answer_description,
+            game_id=self.game_id,
+            on_reply=first_reply,
+            context=self.ai_context,
+        ))
+        elapsed = time.perf_counter() - started
+        if not replied:
+            # キャッシュから返した場合やストリーミングしない場合は、全体の結果が最初の応答になる
+            latency["first_feedback"].add(elapsed)
+        latency["full"].add(elapsed)
+        return res
+
+    # 明らかな回答をAIを使わずに判定する。判断できない場合はNoneを返す
+    def prejudge(self, answer: str) -> Optional[Ai_Agent.Answer_schema]:
+        key = normalize_text(answer)
+        if not key:
+            # 記号や空白だけの回答
+            return Ai_Agent.Answer_schema(is_correct=False, is_close=False)
+        if key in self.answer_verdicts:
+            return self.answer_verdicts[key]
+
+        if judge_keys(answer) & self.answer_keys or romaji_keys(answer) & self.answer_romaji_keys:
+            return Ai_Agent.Answer_schema(is_correct=True, is_close=False)
+        return None
+
+    # 答え・別名と長音だけ、または1文字だけ違う回答か（AIが不正解とした場合に「惜しい」とするだけで、正解にはしない）
+    def is_near_miss(self, answer: str) -> bool:
+        guesses = judge_keys(answer)
+        folded = {fold_long_vowels(key) for key in self.answer_keys}
+        return any(fold_long_vowels(guess) in folded for guess in guesses) or any(
+            min(len(guess), len(correct)) >= PREJUDGE_MIN_LENGTH
+            and edit_distance(guess, correct, PREJUDGE_MAX_DISTANCE) <= PREJUDGE_MAX_DISTANCE
+            for guess in guesses
+            for correct in self.answer_keys
         )
 
     async def ai_answer(self, answer: str):
-        self.pending_ai_answers += 1
-        try:
-            return await self.ai_agent.answer(
+        stats = self.game_manager.prejudge_stats
+        res = self.prejudge(answer)
+        if res is not None:
+            stats["correct" if res.is_correct else "incorrect"] += 1
+            return res
+
+        stats["llm"] += 1
+        if self.answer_batcher.window > 0 and self.answer_batcher.max_size > 1:
+            res = await self.in_flight.run(self.answer_batcher.run(answer))
+        else:
+            res = await self.in_flight.run(self.ai_agent.answer(
                 genre=self.genre,
                 answer=self.answer,
                 question=answer,
                 answer_description=self.answer_description,
-            )
-        finally:
-            self.pending_ai_answers -= 1
+                game_id=self.game_id,
+                context=self.ai_context,
+            ))
+        if not res.is_correct and not res.is_close and self.is_near_miss(answer):
+            stats["near_miss"] += 1
+            res = Ai_Agent.Answer_schema(is_correct=False, is_close=True)
+        self.answer_verdicts[normalize_text(answer)] = res
+        return res
+
+    async def _judge_answers(self, answers: list[str]) -> list[Ai_Agent.Answer_schema]:
+        return await self.ai_agent.answer_batch(
+            genre=self.genre,
+            answer=self.answer,
+            questions=answers,
+            answer_description=self.answer_description,
+            game_id=self.game_id,
+            context=self.ai_context,
+        )
 
     # イベント配信（レスポンスは個別に）
-    async def broadcast(self, data: schemes.WSEvent):
-        async def send(data: schemes.WSEvent, ws: WebSocket):
-            try:
-                await ws.send_text(data.root.model_dump_json())
-            except Exception:
-                print(f"{ws.client}への送信に失敗")
-        await asyncio.gather(*(send(data, ws) for ws in self.connections.keys()))
+    def broadcast(self, data: schemes.WSEvent):
+        # シリアライズはエンコーディングごとに1回だけ行い、各コネクションの送信キューに積む
+        frames: dict[str, str | bytes] = {}
+        droppable = data.root.type in DROPPABLE_TYPES
+        for writer in self.writers.values():
+            frame = frames.get(writer.encoding)
+            if frame is None:
+                frame = frames[writer.encoding] = self._encode(data, writer.encoding)
+            writer.put(frame, droppable)
+
+    # 1つのコネクションにだけ送る
+    def send(self, ws: WebSocket, data: schemes.WSEvent):
+        writer = self.writers.get(ws)
+        if writer:
+            writer.put(self._encode(data, writer.encoding), droppable=False)
+
+    def _encode(self, data: schemes.WSEvent, encoding: str) -> str | bytes:
+        if encoding == schemes.COMPACT_ENCODING:
+            return schemes.encode_compact(data.root, self.interner)
+        return data.root.model_dump_json()
+
+    def connection_stats(self) -> list[dict]:
+        return [
+            {"user": str(self.connections.get(ws)), **writer.stats()}
+            for ws, writer in self.writers.items()
+        ]
 
     # タイムアウト時に呼び出される
     async def game_over(self):
-        self.state = "finished"
+        self.set_state("finished")
 
-        await self.broadcast(schemes.WSEvent(root=schemes.Event(type="timeup")))
+        self.broadcast(schemes.WSEvent(root=schemes.Event(type="timeup")))
         
-        while self.pending_ai_answers > 0:
-            await asyncio.sleep(0.1)
-            
+        # 判定中の回答を待ってから結果を発表する（期限を過ぎたものはキャンセル）
+        if not await self.in_flight.wait(self.game_manager.result_wait_timeout):
+            print(f"ゲーム{self.game_id}：判定待ちの期限切れ")
+
         # 結果発表～！を配信
-        await self.broadcast(
+        self.broadcast(
             schemes.WSEvent(
                 root=schemes.Result(
                     correct_answer=self.answer,
@@ -190,40 +901,556 @@ class Game_data:
         print("新規ゲームを作成")
         await asyncio.sleep(5)
         
-        new_game_data = self.initial_post_data.model_copy(deep=True)
-        if self.manual_next_answer:
-            new_game_data.answer = self.manual_next_answer
-        else:
-            with open("themes.txt", "r", encoding="utf-8") as f:
-                themes = f.readlines()
-            new_game_data.answer = random.choice(themes).strip()
-
-        new_game_id = await self.game_manager.create_game(new_game_data)
+        new_game_id = await self._create_next_game()
+        if new_game_id is None:
+            self.broadcast(schemes.WSEvent(root=schemes.Response(text="次のゲームを作成できませんでした。")))
+            return
         print(f"新規ゲームID：{new_game_id}")
-        await self.broadcast(
+        self.broadcast(
             schemes.WSEvent(root=schemes.NewGame_Redirect(game_id=new_game_id))
         )
-        self.state = "redirected"
         self.new_game_id = new_game_id
+        self.set_state("redirected")
+
+    # 次のゲームを作成する。AIの混雑などで失敗した場合は間隔を空けてやり直し、それでも作れなければNone
+    async def _create_next_game(self) -> Optional[int]:
+        for attempt in range(NEXT_GAME_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(NEXT_GAME_RETRY_DELAY * attempt)
+            new_game_data = self.initial_post_data.model_copy(deep=True)
+            try:
+                if self.manual_next_answer:
+                    new_game_data.answer = self.manual_next_answer
+                    return await self.game_manager.create_game(new_game_data, room_id=self.room_id)
+                return await self.game_manager.create_next_game(new_game_data, self.room_id)
+            except HTTPException as e:
+                print(f"ゲーム{self.game_id}：次のゲームの作成に失敗（{attempt + 1}回目）：{e.status_code} {e.detail}")
+                if e.status_code == 400 and self.manual_next_answer:
+                    # 手動で設定されたお題が使えない場合は山札から出題する
+                    self.manual_next_answer = None
+            except ValueError as e:
+                # お題リストの更新で、ルームのジャンルに合うお題がなくなった場合はジャンルの指定を外す
+                print(f"ゲーム{self.game_id}：次のゲームの作成に失敗（{attempt + 1}回目）：{e}")
+                self.game_manager.themes.room(self.room_id).genres = None
+            except Exception as e:
+                print(f"ゲーム{self.game_id}：次のゲームの作成に失敗（{attempt + 1}回目）：{e!r}")
+        return None
+
+
+# ルーム（同じ設定で続けて遊ぶゲームの連なり）ごとのお題の山札と履歴
+class Room_deck:
+    def __init__(self, room_id: int, genres: Optional[frozenset[str]], history_size: int):
+        self.room_id = room_id
+        self.genres = genres                        # 出題するジャンル（Noneならすべて）
+        self.deck: list[str] = []                   # 残りの山札（末尾から引く）
+        self.recent: deque[str] = deque()           # 直近に出題したお題（古い順）
+        self.recent_counts: Counter[str] = Counter()
+        self.history_size = history_size
+        self.draws = 0
+        self.reshuffles = 0
+
+    def record(self, theme: str):
+        self.recent.append(theme)
+        self.recent_counts[theme] += 1
+        if len(self.recent) > self.history_size:
+            old = self.recent.popleft()
+            self.recent_counts[old] -= 1
+            if not self.recent_counts[old]:
+                del self.recent_counts[old]
+
+    def stats(self) -> dict:
+        return {
+            "genres": sorted(self.genres) if self.genres else None,
+            "remaining": len(self.deck),
+            "recent": list(self.recent),
+            "draws": self.draws,
+            "reshuffles": self.reshuffles,
+        }
+
+
+# お題の出題順を決める
+# 重みの数だけお題を入れた山札をシャッフルして末尾から引くので、1回の抽選はO(1)
+# 山札の一番上が直近avoid_last回のお題なら、ランダムな位置と最大max_swaps回入れ替えて避ける
+class Theme_scheduler:
+    def __init__(self, themes_path: str, avoid_last: int = 10, max_swaps: int = 8):
+        self.resource = File_resource(themes_path, parse_themes)   # ファイルが更新されたら読み直す
+        self.avoid_last = avoid_last
+        self.max_swaps = max_swaps
+        self.rooms: dict[int, Room_deck] = {}
+        self.rejected: set[str] = set()             # AIが使えないと判定したお題
+        self._entries: list[Theme_entry] = []
+
+    def _sync(self):
+        entries = self.resource.get()
+        if entries is not self._entries:
+            # お題リストが変わったら山札を作り直す
+            self._entries = entries
+            self.rejected.clear()
+            for room in self.rooms.values():
+                room.deck.clear()
+
+    def room(self, room_id: int, genres: Optional[list[str]] = None) -> Room_deck:
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = Room_deck(room_id, frozenset(genres) if genres else None, self.avoid_last)
+        return room
+
+    def forget(self, room_id: int):
+        self.rooms.pop(room_id, None)
+
+    def _fill(self, room: Room_deck):
+        room.deck = [
+            entry.theme
+            for entry in self._entries
+            if entry.theme not in self.rejected and (room.genres is None or entry.genre in room.genres)
+            for _ in range(entry.weight)
+        ]
+        if not room.deck:
+            raise ValueError(f"ルーム{room.room_id}で出題できるお題がありません")
+        random.shuffle(room.deck)
+        room.reshuffles += 1
+
+    # 次に出るお題を山札の一番上に用意する
+    def _top(self, room: Room_deck) -> str:
+        self._sync()
+        deck = room.deck
+        while deck and deck[-1] in self.rejected:
+            deck.pop()
+        if not deck:
+            self._fill(room)
+            deck = room.deck
+        if deck[-1] in room.recent_counts:
+            for _ in range(self.max_swaps):
+                i = random.randrange(len(deck))
+                if deck[i] not in room.recent_counts and deck[i] not in self.rejected:
+                    deck[i], deck[-1] = deck[-1], deck[i]
+                    break
+        return deck[-1]
+
+    # 指定したジャンル（Noneならすべて）に出題できるお題があるか
+    def has_themes(self, genres: Optional[list[str]] = None) -> bool:
+        self._sync()
+        return any(
+            entry.theme not in self.rejected and (not genres or entry.genre in genres)
+            for entry in self._entries
+        )
+
+    # 次に出るお題を引かずに見る（事前検証用）
+    def peek(self, room_id: int) -> str:
+        return self._top(self.room(room_id))
+
+    def draw(self, room_id: int) -> str:
+        room = self.room(room_id)
+        theme = self._top(room)
+        room.deck.pop()
+        room.draws += 1
+        return theme
+
+    # 出題したお題を履歴に残す（手動で指定したお題も含む）
+    def record(self, room_id: int, theme: str):
+        self.room(room_id).record(theme)
+
+    def reject(self, theme: str):
+        self.rejected.add(theme)
+
+    def stats(self) -> dict:
+        return {
+            **self.resource.stats(),
+            "themes": len(self._entries),
+            "genres": Counter(entry.genre for entry in self._entries if entry.genre),
+            "avoid_last": self.avoid_last,
+            "rejected": sorted(self.rejected),
+            "rooms": {room_id: room.stats() for room_id, room in self.rooms.items()},
+        }
+
+    def entries(self) -> list[dict]:
+        self._sync()
+        return [
+            {"theme": entry.theme, "weight": entry.weight, "genre": entry.genre, "rejected": entry.theme in self.rejected}
+            for entry in self._entries
+        ]
 
 
 class GameManager:
-    def __init__(self, ai_agent: Ai_Agent):
+    def __init__(
+        self,
+        ai_agent: Ai_Agent,
+        result_wait_timeout: float = 20.0,
+        send_timeout: float = 5.0,
+        send_queue_size: int = 64,
+        game_ttl: float = 30 * 60,
+        sweep_interval: float = 60,
+        archive_path: Optional[str] = "data/game_archive.jsonl",
+        themes_path: str = "themes.txt",
+        avoid_last: int = 10,
+        backend: Optional[State_backend] = None,
+        owns: Optional[Callable[[int], bool]] = None,
+        event_log: Optional[Event_log] = None,
+        answer_batch_window: float = 0.1,
+        answer_batch_size: int = 8,
+    ):
         self.games: dict[int, Game_data] = {}
         self.ai = ai_agent
+        self.themes = Theme_scheduler(themes_path, avoid_last)  # ルームごとのお題の出題順
+        self.result_wait_timeout = result_wait_timeout  # 結果発表前に判定中のAI呼び出しを待つ秒数
+        self.send_timeout = send_timeout                # 1つのコネクションへの送信を待つ秒数
+        self.send_queue_size = send_queue_size          # コネクションごとの送信キューの上限
+        self.prejudge_stats: Counter[str] = Counter()   # 回答の事前判定の集計（correct/incorrect: ローカル判定、llm: AI判定、near_miss: AIが不正解とした1文字違いの回答）
+        # 質問を受けてから最初の応答（返答の一言）と、確定した返答までの時間
+        self.question_latency = {"first_feedback": Latency_recorder(), "full": Latency_recorder()}
+        # 同じゲームに短い間に届いた回答をまとめてAIで判定する（windowが0かsizeが1ならまとめない）
+        self.answer_batch_window = answer_batch_window  # 最初の回答から判定を始めるまで待つ秒数
+        self.answer_batch_size = answer_batch_size      # 1回にまとめる回答の上限
+        self.answer_batch_stats: Counter[str] = Counter()
+
+        # 各ルームで次に出るお題の検証結果を蓄えておくプール（キー: お題の原文）
+        self.theme_pool: dict[str, Ai_Agent.Check_game_thema] = {}
+        self.pool_stats: Counter[str] = Counter()
+        self._refill_task: Optional[asyncio.Task] = None
+
+        # 終了したゲームの退避
+        self.game_ttl = game_ttl                # 終了後、接続がなくなってからメモリに残しておく秒数
+        self.sweep_interval = sweep_interval    # 退避処理の間隔（秒）
+        self.archive_path = archive_path        # 退避したゲームの記録先（JSON Lines）。Noneなら記録しない
+        self.eviction_stats: Counter[str] = Counter()
+        self._sweep_task: Optional[asyncio.Task] = None
+
+        # 複数のワーカーで動かすときの状態バックエンドと、ワーカー間の中継
+        self.backend = backend or Memory_backend()
+        self.owns = owns    # このワーカーが担当するゲームIDか（コンシステントハッシュでのルーティング時）。Noneならすべて
+        self.relays: dict[str, Connection_writer] = {}          # このワーカーが受け付け、他のワーカーのゲームに中継しているWebSocket
+        self.remote_sockets: dict[str, Remote_socket] = {}      # 他のワーカーが受け付けた、このワーカーのゲームへの接続
+        self.relay_stats: Counter[str] = Counter()
+        self.saved_seqs: dict[int, int] = {}                    # バックエンドに書き込み済みのシーケンス番号（ゲームごと）
+        # 他のワーカーから中継された接続を処理する関数（server.pyで設定する）
+        self.on_remote_connection: Optional[Callable[[Remote_socket, Game_data], Awaitable[None]]] = None
+        self._backend_task: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()      # 結果を待たないタスク（参照を持っておかないと途中で回収されることがある）
+
+        # 再起動しても進行中のゲームを復元できるよう、変更をイベントログに記録する
+        self.event_log = event_log
+        self.restore_stats: dict = {}
+
+    def log_event(self, event: dict):
+        if self.event_log:
+            self.event_log.append(event)
+
+    # スナップショットとイベントログからゲームを復元し、記録を再開する
+    async def restore(self):
+        if self.event_log is None:
+            return
+        started = time.perf_counter()
+        snapshot, events = self.event_log.load()
+        for data in snapshot:
+            self._restore_game(Game_data.from_snapshot(data, self.ai, self))
+        replayed = 0
+        for event in events:
+            replayed += 1
+            if event["type"] == "create":
+                self._restore_game(Game_data.from_snapshot(event, self.ai, self))
+            elif event["type"] == "evict":
+                self.games.pop(event["game_id"], None)
+            elif game := self.games.get(event["game_id"]):
+                game.apply_event(event)
+        dropped = 0
+        for game in list(self.games.values()):
+            if not await self.backend.register_game(game.game_id):
+                # 他のワーカーが進行中のゲームなので、このワーカーでは再開しない
+                print(f"ゲーム{game.game_id}のIDは他のワーカーが使用中です")
+                del self.games[game.game_id]
+                dropped += 1
+                continue
+            self.save_game(game)
+            game.resume()
+        self.event_log.open(self.snapshots)
+        if replayed or dropped:
+            # 次回の起動時に読み直すログを短くする
+            self.event_log.compact()
+        self.restore_stats = {
+            "games": len(self.games),
+            "snapshot_games": len(snapshot),
+            "replayed_events": replayed,
+            "dropped_games": dropped,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        print(f"ゲームを復元：{self.restore_stats}")
+
+    def _restore_game(self, game: Game_data):
+        self.games[game.game_id] = game
+        self.themes.room(game.room_id, game.initial_post_data.genres).record(game.initial_post_data.answer)
+
+    def snapshots(self) -> list[dict]:
+        return [game.snapshot() for game in self.games.values()]
 
-    async def create_game(self, data: schemes.NewGame_Post) -> int:
+    def start(self):
+        self.refill_pool()
+        self._sweep_task = asyncio.create_task(self._sweep_loop())
+        self._backend_task = asyncio.create_task(self._backend_loop())
+
+    # 結果を待たずにタスクを実行する（終わるまで参照を持っておく）
+    def _spawn(self, coro: Coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    # room_idを省略すると新しいルームを作る（ゲームIDがルームIDになる）
+    async def create_game(
+        self,
+        data: schemes.NewGame_Post,
+        checked: Optional[Ai_Agent.Check_game_thema] = None,
+        room_id: Optional[int] = None,
+    ) -> int:
+        # 新しいルームのジャンルに出題できるお題がなければ、次のゲームを作れないので受け付けない
+        if room_id is None and data.genres and not self.themes.has_themes(data.genres):
+            raise HTTPException(400, "指定したジャンルのお題がありません")
+        # ゲームIDは他のワーカーと重複しないようにバックエンドで確保する
+        # ルーティングしている場合は、このワーカーに割り当てられるゲームIDを選ぶ
         game_id = random.randint(100000, 999999)
-        while game_id in self.games:
+        while (self.owns and not self.owns(game_id)) or not await self.backend.register_game(game_id):
             game_id = random.randint(100000, 999999)
+        room_id = room_id or game_id
 
-        self.games[game_id] = await Game_data.__aio_init__(
-            game_id=game_id,
-            post_data=data,
-            ai_agent=self.ai,
-            game_manager=self,
-        )
+        try:
+            game = await Game_data.__aio_init__(
+                game_id=game_id,
+                room_id=room_id,
+                post_data=data,
+                ai_agent=self.ai,
+                game_manager=self,
+                checked=checked,
+            )
+        except BaseException:
+            self.backend.remove_game(game_id)
+            raise
+        self.games[game_id] = game
+        self.log_event({"type": "create", **game.snapshot()})
+        self.save_game(game)
+        self.themes.room(room_id, data.genres).record(data.answer)
+        self.refill_pool()
         return game_id
 
+    # ルームの山札から次のゲームを作成する。プールに検証済みのお題があればすぐに作成できる
+    async def create_next_game(self, data: schemes.NewGame_Post, room_id: int) -> int:
+        for _ in range(3):
+            data.answer = self.themes.draw(room_id)
+            checked = self.theme_pool.pop(data.answer, None)
+            if checked is not None:
+                self.pool_stats["hits"] += 1
+            else:
+                self.pool_stats["misses"] += 1
+                checked = await self.ai.check_game_thema(data.answer)
+            if checked.is_useable:
+                return await self.create_game(data, checked, room_id)
+            self.themes.reject(data.answer)
+        raise HTTPException(503, "使えるお題が見つかりません")
+
+    # プールの補充をバックグラウンドで開始する
+    def refill_pool(self):
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        # 使えないお題が続いてもAIを呼び続けないよう試行回数に上限を設ける
+        for _ in range(len(self.themes.rooms) * 3):
+            try:
+                upcoming = {room_id: self.themes.peek(room_id) for room_id in list(self.themes.rooms)}
+            except ValueError as e:
+                print(f"お題の事前検証に失敗：{e}")
+                return
+            # 次に出ないお題の検証結果は捨てる
+            for theme in self.theme_pool.keys() - upcoming.values():
+                del self.theme_pool[theme]
+            theme = next((theme for theme in upcoming.values() if theme not in self.theme_pool), None)
+            if theme is None:
+                return
+            try:
+                res = await self.ai.check_game_thema(theme)
+            except Exception as e:
+                # 次にゲームが作られたときに再度補充する
+                print(f"お題の事前検証に失敗：{e!r}")
+                self.pool_stats["errors"] += 1
+                return
+            if res.is_useable:
+                self.theme_pool[theme] = res
+                self.pool_stats["validated"] += 1
+            else:
+                self.themes.reject(theme)
+                self.pool_stats["rejected"] += 1
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.evict_finished()
+            except Exception as e:
+                print(f"ゲームの退避に失敗：{e!r}")
+
+    # 終了から一定時間が経ち、接続が残っていないゲームを記録してメモリから取り除く
+    def evict_finished(self) -> int:
+        now = time.monotonic()
+        expired = [
+            game for game in self.games.values()
+            if game.finished_at is not None
+            and not game.connections
+            and now - game.finished_at >= self.game_ttl
+        ]
+        if not expired:
+            return 0
+        if self.archive_path:
+            os.makedirs(os.path.dirname(self.archive_path) or ".", exist_ok=True)
+            with open(self.archive_path, "a", encoding="utf-8") as f:
+                for game in expired:
+                    f.write(json.dumps(game.archive_record(), ensure_ascii=False, separators=(",", ":")) + "\n")
+            self.eviction_stats["archived"] += len(expired)
+        for game in expired:
+            del self.games[game.game_id]
+            self.backend.remove_game(game.game_id)
+            self.saved_seqs.pop(game.game_id, None)
+            self.log_event({"type": "evict", "game_id": game.game_id})
+            if any(prompt.cache_name() for prompt in game.ai_context.prompts):
+                self._spawn(self.ai.release_context(game.ai_context))
+        # ゲームが残っていないルームの山札を捨てる
+        rooms = {game.room_id for game in self.games.values()}
+        for room_id in self.themes.rooms.keys() - rooms:
+            self.themes.forget(room_id)
+        self.eviction_stats["evicted"] += len(expired)
+        return len(expired)
+
+    def answer_batch_stats_summary(self) -> dict:
+        batches = self.answer_batch_stats["batches"]
+        return {
+            "window": self.answer_batch_window,
+            "size": self.answer_batch_size,
+            **self.answer_batch_stats,
+            "average_size": round(self.answer_batch_stats["answers"] / batches, 2) if batches else 0.0,
+        }
+
+    def memory_stats(self) -> dict:
+        return {
+            "games": len(self.games),
+            "by_state": Counter(game.state for game in self.games.values()),
+            "users": sum(len(game.users) for game in self.games.values()),
+            "messages": sum(len(game.messages) for game in self.games.values()),
+            "connections": sum(len(game.connections) for game in self.games.values()),
+            **self.eviction_stats,
+        }
+
+    async def close(self):
+        if self._refill_task:
+            self._refill_task.cancel()
+        if self._sweep_task:
+            self._sweep_task.cancel()
+        if self._backend_task:
+            self._backend_task.cancel()
+        self.backend.close()
+        if self.event_log:
+            self.event_log.close()
+
     def get_game(self, game_id: int) -> Optional[Game_data]:
-        return self.games.get(game_id)
\ No newline at end of file
+        return self.games.get(game_id)
+
+    # 他のワーカーが一覧・詳細を取得できるよう、ゲームの状態をバックエンドに書き込む
+    # 書き込むのは要約とメッセージを除いた詳細、前回から追加されたメッセージだけ
+    def save_game(self, game: Game_data):
+        if not self.backend.shared:
+            return
+        start = bisect.bisect_right(game.message_seqs, self.saved_seqs.get(game.game_id, 0))
+        messages = [
+            (seq, message.to_scheme().model_dump_json())
+            for seq, message in zip(game.message_seqs[start:], game.messages[start:])
+        ]
+        detail = game.to_scheme(since=game.seq)     # メッセージを含まない
+        detail.users = {uid: user.nickname for uid, user in game.users.items()}
+        self.backend.update_game(game.game_id, game.summary(), detail.model_dump_json(), messages)
+        self.saved_seqs[game.game_id] = game.seq
+
+    # 他のワーカーのゲームも含めた一覧
+    async def list_games(self) -> dict[int, dict]:
+        games = await self.backend.games()
+        for game_id, game in self.games.items():
+            games[game_id] = game.summary()
+        return games
+
+    # 次のゲームのお題を手動で指定する（他のワーカーのゲームならそのワーカーに依頼する）
+    async def set_next_answer(self, game_id: int, answer: str) -> bool:
+        game = self.games.get(game_id)
+        if game:
+            game.set_next_answer(answer)
+            return True
+        owner = await self.backend.owner(game_id)
+        if owner is None:
+            return False
+        self.backend.publish(owner, {"kind": "set_next_answer", "game_id": game_id, "answer": answer})
+        return True
+
+    # 他のワーカーのゲームへの接続を、そのワーカーに中継する
+    async def relay(self, ws: WebSocket, game_id: int, owner: str):
+        conn_id = uuid.uuid4().hex
+        self.relays[conn_id] = Connection_writer(
+            ws,
+            maxsize=self.send_queue_size,
+            send_timeout=self.send_timeout,
+            on_dead=lambda ws: None,
+        )
+        self.relay_stats["relayed"] += 1
+        self.backend.publish(owner, {
+            "kind": "open",
+            "conn": conn_id,
+            "origin": self.backend.worker_id,
+            "game_id": game_id,
+            "client": str(ws.client),
+            "query_params": dict(ws.query_params),
+        })
+        try:
+            while True:
+                text = await ws.receive_text()
+                self.backend.publish(owner, {"kind": "recv", "conn": conn_id, "text": text})
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.relays.pop(conn_id).close()
+            self.backend.publish(owner, {"kind": "disconnect", "conn": conn_id})
+
+    async def _backend_loop(self):
+        async for message in self.backend.messages():
+            try:
+                self._dispatch(message)
+            except Exception as e:
+                print(f"ワーカー間のメッセージの処理に失敗：{e!r}")
+
+    def _dispatch(self, message: dict):
+        kind = message["kind"]
+        # このワーカーが持つゲームへの接続
+        if kind == "open":
+            game = self.games.get(message["game_id"])
+            if game is None or self.on_remote_connection is None:
+                self.backend.publish(message["origin"], {"kind": "close", "conn": message["conn"], "code": 4000})
+                return
+            socket = Remote_socket(self.backend, message["conn"], message["origin"], message["client"], message["query_params"])
+            self.remote_sockets[socket.conn_id] = socket
+            self._spawn(self._serve_remote(socket, game))
+        elif kind == "recv" or kind == "disconnect":
+            socket = self.remote_sockets.get(message["conn"])
+            if socket:
+                socket.feed(message.get("text"))
+        elif kind == "set_next_answer":
+            game = self.games.get(message["game_id"])
+            if game:
+                game.set_next_answer(message["answer"])
+        # このワーカーが受け付けたWebSocketへの送信
+        elif kind == "send":
+            writer = self.relays.get(message["conn"])
+            if writer:
+                frame = base64.b64decode(message["bytes"]) if "bytes" in message else message["text"]
+                writer.put(frame, message["droppable"])
+        elif kind == "close":
+            writer = self.relays.get(message["conn"])
+            if writer:
+                self._spawn(writer.ws.close(code=message["code"]))
+
+    async def _serve_remote(self, socket: Remote_socket, game: Game_data):
+        try:
+            await self.on_remote_connection(socket, game) # type: ignore
+        finally:
+            self.remote_sockets.pop(socket.conn_id, None)
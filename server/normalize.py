@@ -0,0 +1,121 @@
+import unicodedata
+
+# 句読点・空白・制御文字として取り除くUnicodeカテゴリ
+_STRIP_CATEGORIES = ("P", "Z", "C")
+
+
+def to_hiragana(text: str) -> str:
+    """カタカナをひらがなに変換する"""
+    return "".join(
+        chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c
+        for c in text
+    )
+
+
+def normalize_text(text: str) -> str:
+    """表記揺れを吸収した比較用の文字列を返す
+
+    全角・半角の統一（NFKC）、大文字・小文字の統一、カタカナのひらがな化を行い、
+    句読点と空白を取り除く。
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = to_hiragana(text)
+    return "".join(
+        c for c in text
+        if not unicodedata.category(c).startswith(_STRIP_CATEGORIES)
+    )
+
+
+# ローマ字→ひらがなの変換表（ヘボン式・訓令式）
+_ROMAJI_TABLE = {
+    "a": "あ", "i": "い", "u": "う", "e": "え", "o": "お",
+    "ka": "か", "ki": "き", "ku": "く", "ke": "け", "ko": "こ",
+    "ga": "が", "gi": "ぎ", "gu": "ぐ", "ge": "げ", "go": "ご",
+    "sa": "さ", "shi": "し", "si": "し", "su": "す", "se": "せ", "so": "そ",
+    "za": "ざ", "ji": "じ", "zi": "じ", "zu": "ず", "ze": "ぜ", "zo": "ぞ",
+    "ta": "た", "chi": "ち", "ti": "ち", "tsu": "つ", "tu": "つ", "te": "て", "to": "と",
+    "da": "だ", "di": "ぢ", "du": "づ", "de": "で", "do": "ど",
+    "na": "な", "ni": "に", "nu": "ぬ", "ne": "ね", "no": "の",
+    "ha": "は", "hi": "ひ", "fu": "ふ", "hu": "ふ", "he": "へ", "ho": "ほ",
+    "ba": "ば", "bi": "び", "bu": "ぶ", "be": "べ", "bo": "ぼ",
+    "pa": "ぱ", "pi": "ぴ", "pu": "ぷ", "pe": "ぺ", "po": "ぽ",
+    "ma": "ま", "mi": "み", "mu": "む", "me": "め", "mo": "も",
+    "ya": "や", "yu": "ゆ", "yo": "よ",
+    "ra": "ら", "ri": "り", "ru": "る", "re": "れ", "ro": "ろ",
+    "wa": "わ", "wo": "を", "nn": "ん", "vu": "ゔ",
+    "fa": "ふぁ", "fi": "ふぃ", "fe": "ふぇ", "fo": "ふぉ",
+    "ja": "じゃ", "ju": "じゅ", "jo": "じょ", "je": "じぇ",
+    "sha": "しゃ", "shu": "しゅ", "sho": "しょ", "she": "しぇ",
+    "cha": "ちゃ", "chu": "ちゅ", "cho": "ちょ", "che": "ちぇ",
+}
+for _consonant, _kana in {
+    "k": "き", "g": "ぎ", "s": "し", "z": "じ", "t": "ち", "d": "ぢ", "n": "に",
+    "h": "ひ", "b": "び", "p": "ぴ", "m": "み", "r": "り", "j": "じ", "c": "ち",
+}.items():
+    for _vowel, _small in (("a", "ゃ"), ("u", "ゅ"), ("o", "ょ")):
+        _ROMAJI_TABLE.setdefault(f"{_consonant}y{_vowel}", _kana + _small)
+
+
+def romaji_to_hiragana(text: str) -> str | None:
+    """ローマ字の文字列をひらがなに変換する。変換できない場合はNoneを返す"""
+    if not text.isascii() or not text.isalpha():
+        return None
+    text = text.lower()
+    result: list[str] = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        nxt = text[i + 1] if i + 1 < len(text) else ""
+        # 促音（kk, tt, tch など）
+        if c not in "aiueon" and nxt and (nxt == c or (c == "t" and nxt == "c")):
+            result.append("っ")
+            i += 1
+            continue
+        # 撥音（子音の前・末尾のn。「nn」の後に母音が続かなければまとめて1つ）
+        if c == "n" and (not nxt or nxt not in "aiueoy"):
+            after = text[i + 2] if i + 2 < len(text) else ""
+            result.append("ん")
+            i += 2 if nxt == "n" and (not after or after not in "aiueoy") else 1
+            continue
+        for length in (3, 2, 1):
+            kana = _ROMAJI_TABLE.get(text[i:i + length])
+            if kana:
+                result.append(kana)
+                i += length
+                break
+        else:
+            return None
+    return "".join(result)
+
+
+# 長音として扱う「う」の直前に来るかな（お段・う段）
+_LONG_VOWEL_BEFORE = set("おこごそぞとどのほぼぽもよょろをうくぐすずつづぬふぶぷむゆゅるゔ")
+
+
+def fold_long_vowels(text: str) -> str:
+    """長音（「ー」やお段・う段に続く「う」）を取り除く。「とうきょう」と「ときょ」（tokyo）を同一視するために使う"""
+    result: list[str] = []
+    for c in text:
+        if c == "ー" or (c == "う" and result and result[-1] in _LONG_VOWEL_BEFORE):
+            continue
+        result.append(c)
+    return "".join(result)
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """レーベンシュタイン距離を返す。limitを超えた時点でlimit+1を返して打ち切る"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ca != cb),
+            ))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
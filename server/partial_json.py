@@ -0,0 +1,36 @@
+import json
+import re
+
+_KEY_RE = re.compile(r'\s*[{,]?\s*"((?:[^"\\]|\\.)*)"\s*:\s*')
+_DECODER = json.JSONDecoder()
+
+
+# ストリーミングで届くJSONオブジェクトから、値が確定したフィールドを順に取り出す
+# 文字列は閉じる"が届いた時点で、数値・真偽値は後ろに,か}が届いた時点で確定とみなす
+class Partial_json_object:
+    def __init__(self):
+        self.buffer = ""
+        self.fields: dict = {}
+        self._pos = 0       # 次のフィールドを探し始める位置
+
+    # テキストを追加し、新しく確定したフィールドを返す
+    def feed(self, text: str) -> dict:
+        self.buffer += text
+        completed = {}
+        while True:
+            m = _KEY_RE.match(self.buffer, self._pos)
+            if not m:
+                break
+            try:
+                value, end = _DECODER.raw_decode(self.buffer, m.end())
+            except json.JSONDecodeError:
+                break
+            if not isinstance(value, (str, dict, list)):
+                # 数値・真偽値はまだ続きが届くかもしれない
+                rest = self.buffer[end:].lstrip()
+                if not rest or rest[0] not in ",}":
+                    break
+            key = json.loads(f'"{m.group(1)}"')
+            self.fields[key] = completed[key] = value
+            self._pos = end
+        return completed
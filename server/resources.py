@@ -0,0 +1,78 @@
+import gzip
+import hashlib
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+# ファイルを一度だけ読み込んでメモリに保持し、更新時刻が変わったら読み直す
+class File_resource(Generic[T]):
+    def __init__(self, path: str, loader: Callable[[bytes], T], check_interval: float = 1.0):
+        self.path = path
+        self.loader = loader                    # ファイルの中身から保持する値を作る関数
+        self.check_interval = check_interval    # 更新時刻を確認する間隔（秒）
+        self._value: Optional[T] = None
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self.loads = 0
+
+    def get(self) -> T:
+        now = time.monotonic()
+        if self._value is None or now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self._mtime:
+                with open(self.path, "rb") as f:
+                    self._value = self.loader(f.read())
+                self._mtime = mtime
+                self.loads += 1
+                print(f"[resource] loaded {self.path}")
+        return self._value # type: ignore
+
+    def stats(self) -> dict:
+        return {"path": self.path, "loads": self.loads}
+
+
+class Static_body:
+    def __init__(self, body: bytes):
+        self.body = body
+        self.gzip_body = gzip.compress(body)
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+# admin.htmlなどの静的ファイル。ETagとgzip済みの本文を保持する
+class Static_asset(File_resource[Static_body]):
+    def __init__(self, path: str, check_interval: float = 1.0):
+        super().__init__(path, Static_body, check_interval)
+
+
+# お題リストの1行分
+@dataclass(frozen=True, slots=True)
+class Theme_entry:
+    theme: str
+    weight: int = 1                 # 山札に入れる枚数（出やすさ）
+    genre: Optional[str] = None
+
+
+# 1行に1つのお題。「お題 | 重み | ジャンル」の形式で重みとジャンルを指定できる（どちらも省略可）
+# 空行と#で始まる行は無視する
+def parse_themes(data: bytes) -> list[Theme_entry]:
+    entries: list[Theme_entry] = []
+    for line in data.decode("utf-8").splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        theme, *options = [part.strip() for part in line.split("|")]
+        weight = 1
+        if options and options[0]:
+            try:
+                weight = max(int(options[0]), 0)
+            except ValueError:
+                print(f"[resource] invalid weight: {line}")
+        genre = options[1] if len(options) > 1 and options[1] else None
+        if theme and weight:
+            entries.append(Theme_entry(theme, weight, genre))
+    return entries
@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import itertools
+import os
+import subprocess
+import sys
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import httpx
+import uvicorn
+import websockets
+from fastapi import FastAPI, Request, WebSocket
+from fastapi.responses import JSONResponse, Response
+
+from routing import Hash_ring
+
+# ゲームIDごとに担当のワーカーへ振り分ける前段のルーター
+# ワーカーはWORKERS（カンマ区切りのURL）とWORKER_URL（自分のURL）を指定して起動したserver.py
+# 各ワーカーは自分が担当するゲームIDでしかゲームを作らないので、ワーカー間のロックや共有状態は不要
+
+# 転送しないヘッダー（httpxが本文を展開するためContent-Encodingも落とす）
+_HOP_HEADERS = {"host", "connection", "content-length", "content-encoding", "transfer-encoding"}
+
+ring: Hash_ring
+client: httpx.AsyncClient
+_round_robin: itertools.cycle
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global ring, client, _round_robin
+    ring = Hash_ring([url.strip() for url in os.environ["WORKERS"].split(",") if url.strip()])
+    _round_robin = itertools.cycle(ring.nodes)
+    client = httpx.AsyncClient(timeout=60.0)
+    yield
+    await client.aclose()
+
+fastapi = FastAPI(lifespan=lifespan)
+
+
+def _worker_for(path: str) -> Optional[str]:
+    first = path.split("/", 1)[0]
+    return ring.node_for(int(first)) if first.isdigit() else None
+
+
+async def _forward(worker: str, request: Request, path: str, body: bytes) -> httpx.Response:
+    return await client.request(
+        request.method,
+        f"{worker}/{path}",
+        params=request.query_params,
+        headers={k: v for k, v in request.headers.items() if k.lower() not in _HOP_HEADERS},
+        content=body,
+    )
+
+
+def _response(res: httpx.Response) -> Response:
+    return Response(
+        res.content,
+        status_code=res.status_code,
+        headers={k: v for k, v in res.headers.items() if k.lower() not in _HOP_HEADERS},
+    )
+
+
+@fastapi.api_route("/{path:path}", methods=["GET", "POST"])
+async def forward(request: Request, path: str):
+    body = await request.body()
+    # 全ワーカーの情報をまとめるエンドポイント
+    if path in ("game_list", "themes", "stats"):
+        results = await asyncio.gather(*(_forward(worker, request, path, body) for worker in ring.nodes))
+        for res in results:
+            if res.status_code != 200:
+                return _response(res)
+        if path == "game_list":
+            return JSONResponse({k: v for res in results for k, v in res.json().items()})
+        if path == "themes":
+            merged = results[0].json()
+            for res in results[1:]:
+                merged["rooms"].update(res.json()["rooms"])
+            return JSONResponse(merged)
+        return JSONResponse({worker: res.json() for worker, res in zip(ring.nodes, results)})
+
+    # /{game_id}/... は担当のワーカーへ、それ以外（新規ゲーム作成など）は順番に振り分ける
+    worker = _worker_for(path) or next(_round_robin)
+    return _response(await _forward(worker, request, path, body))
+
+
+@fastapi.websocket("/{game_id}/")
+async def forward_websocket(ws: WebSocket, game_id: int):
+    url = ring.node_for(game_id).replace("http", "ws", 1) + f"/{game_id}/"
+    if ws.url.query:
+        url += "?" + ws.url.query
+    try:
+        upstream = await websockets.connect(url)
+    except websockets.InvalidStatus:
+        # ワーカーが接続を拒否した（存在しないゲームID）
+        await ws.close(code=4000, reason="Unknown game ID.")
+        return
+    except OSError:
+        await ws.close(code=1011)
+        return
+    await ws.accept()
+
+    async def client_to_worker():
+        while True:
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            await upstream.send(message["text"] if message.get("text") is not None else message["bytes"])
+
+    async def worker_to_client():
+        try:
+            async for frame in upstream:
+                if isinstance(frame, bytes):
+                    await ws.send_bytes(frame)
+                else:
+                    await ws.send_text(frame)
+        except websockets.ConnectionClosed:
+            pass
+        await ws.close(code=upstream.close_code or 1000)
+
+    tasks = [asyncio.create_task(client_to_worker()), asyncio.create_task(worker_to_client())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await upstream.close()
+
+
+# ワーカーを起動してからルーターを起動する
+# 例: python router.py --workers 4 --port 80
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ゲームIDごとにワーカーへ振り分けるルーターを起動します")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--worker-base-port", type=int, default=8001)
+    args = parser.parse_args()
+
+    urls = [f"http://127.0.0.1:{args.worker_base_port + i}" for i in range(args.workers)]
+    os.environ["WORKERS"] = ",".join(urls)
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:fastapi", "--host", "127.0.0.1", "--port", str(args.worker_base_port + i)],
+            env={**os.environ, "WORKER_URL": url},
+        )
+        for i, url in enumerate(urls)
+    ]
+    try:
+        uvicorn.run(fastapi, host=args.host, port=args.port)
+    finally:
+        for process in processes:
+            process.terminate()
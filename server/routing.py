@@ -0,0 +1,39 @@
+import bisect
+import hashlib
+from typing import Optional
+
+
+# ゲームIDをワーカーに割り当てるコンシステントハッシュ
+# ワーカーを増減しても、移動するゲームIDは全体の一部だけで済む
+class Hash_ring:
+    def __init__(self, nodes: list[str], replicas: int = 100):
+        if not nodes:
+            raise ValueError("Hash_ring needs at least one node")
+        self.nodes = list(nodes)
+        self.replicas = replicas    # 1ワーカーあたりのリング上の仮想ノード数（偏りを減らす）
+        points = sorted(
+            (self._hash(f"{node}#{i}"), node)
+            for node in self.nodes
+            for i in range(replicas)
+        )
+        self._keys = [key for key, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def node_for(self, game_id: int) -> str:
+        i = bisect.bisect(self._keys, self._hash(str(game_id))) % len(self._keys)
+        return self._nodes[i]
+
+
+# WORKERS（カンマ区切りのワーカーのURL）とWORKER_URL（自分のURL）から、自分が担当するゲームIDかを判定する関数を作る
+# 設定がなければNone（すべてのゲームIDを担当する）
+def shard_filter(workers: Optional[str], worker_url: Optional[str]):
+    if not workers or not worker_url:
+        return None
+    ring = Hash_ring([url.strip() for url in workers.split(",") if url.strip()])
+    if worker_url not in ring.nodes:
+        raise ValueError(f"WORKER_URL {worker_url} is not in WORKERS")
+    return lambda game_id: ring.node_for(game_id) == worker_url
@@ -1,7 +1,8 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, TypeAdapter
 import datetime
-from typing import Literal, Union, Optional, List, Dict
+from typing import Annotated, Any, Literal, Union, Optional, List, Dict, get_args, get_origin
 import uuid
+import msgpack
 
 # WebSocketイベント用
 ## 受信用：参加宣言
@@ -70,16 +71,139 @@ class NewGame_Redirect(BaseModel):
     type: Literal["redirect"] = "redirect"
     game_id:int
 
+## 配信用：ゲーム状態のスナップショット（参加時と状態の変化時）
+class Status(BaseModel):
+    type: Literal["status"] = "status"
+    seq: int
+    status: Literal['waiting', 'playing', 'finished', 'redirected']
+    genre: str
+    ans_limit: int
+    question_limit: int
+    start_time: Optional[datetime.datetime]
+    end_time: Optional[datetime.datetime]
+    users: Dict[uuid.UUID, str]
+    remaining_question: Dict[uuid.UUID, int]
+    remaining_answering: Dict[uuid.UUID, int]
+
 ## メッセージ表示用
 class Response(BaseModel):
     type: Literal["response"] = "response"
     text: str
+    partial: bool = False   # 途中経過（後から確定した内容のResponseが届く）
+
+# typeで振り分ける（先頭から順に検証を試さない）
+WSEvent_root = Annotated[
+    Union[Ready, Result, JoinDeclare, Question, Answer, Event, Res_Question, Res_Answer, NewGame_Redirect, Status, Response],
+    Field(discriminator="type"),
+]
 
 class WSEvent(BaseModel):
-    root: Union[Ready, Result, JoinDeclare, Question, Answer, Event, Res_Question, Res_Answer, NewGame_Redirect, Response]
+    root: WSEvent_root
+
+# 受信したフレームを直接デコードする
+ws_event_adapter: TypeAdapter[WSEvent_root] = TypeAdapter(WSEvent_root)
+
+
+# コンパクトエンコーディング（接続時に ?encoding=msgpack を指定した場合）
+## フレームは [type, フィールド1, フィールド2, ...] の配列（フィールドはモデルの定義順）をmsgpackにしたもの
+## user_idはゲームごとの小さな整数に置き換え、対応表は ["intern", [[番号, user_id, ニックネーム], ...]] で先に送る
+## 対応表にあるユーザーのnicknameは省略し、受信側で対応表から復元する
+COMPACT_ENCODING = "msgpack"
+
+_EVENT_CLASSES: Dict[str, type[BaseModel]] = {
+    literal: cls
+    for cls in get_args(get_args(WSEvent_root)[0])
+    for literal in get_args(cls.model_fields["type"].annotation)
+}
+
+
+class User_interner:
+    """user_idとゲーム内の番号の対応表（送信側）"""
+    def __init__(self):
+        self.numbers: Dict[uuid.UUID, int] = {}
+        self.entries: List[list] = []      # [番号, user_id, ニックネーム]
+
+    def intern(self, user_id: uuid.UUID, nickname: str) -> list:
+        if user_id not in self.numbers:
+            self.numbers[user_id] = len(self.entries)
+            self.entries.append([len(self.entries), str(user_id), nickname])
+        return self.entries[self.numbers[user_id]]
+
+    def number(self, user_id: uuid.UUID) -> Union[int, str]:
+        # 対応表にないユーザーはuser_idの文字列のまま送る
+        return self.numbers.get(user_id, str(user_id))
+
+
+def encode_intern(entries: List[list]) -> bytes:
+    return msgpack.packb(["intern", entries])
+
+
+def encode_compact(event: BaseModel, interner: User_interner) -> bytes:
+    return msgpack.packb(_pack_model(event, interner), datetime=True)
+
+
+def _pack_model(model: BaseModel, interner: User_interner) -> list:
+    user_id = getattr(model, "user", None) or getattr(model, "user_id", None)
+    return [
+        None if name == "nickname" and user_id in interner.numbers else _pack(getattr(model, name), interner)
+        for name in type(model).model_fields
+    ]
+
+
+def _pack(value: Any, interner: User_interner) -> Any:
+    if isinstance(value, BaseModel):
+        return _pack_model(value, interner)
+    if isinstance(value, uuid.UUID):
+        return interner.number(value)
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, list):
+        return [_pack(item, interner) for item in value]
+    if isinstance(value, dict):
+        return {_pack(key, interner): _pack(item, interner) for key, item in value.items()}
+    return value
+
+
+class Compact_decoder:
+    """コンパクトエンコーディングのフレームをイベントに戻す（受信側）"""
+    def __init__(self):
+        self.users: Dict[int, tuple[uuid.UUID, str]] = {}
+
+    # 対応表のフレームの場合はNoneを返す
+    def decode(self, frame: bytes) -> Optional[BaseModel]:
+        data = msgpack.unpackb(frame, timestamp=3, strict_map_key=False)
+        if data[0] == "intern":
+            for number, user_id, nickname in data[1]:
+                self.users[number] = (uuid.UUID(user_id), nickname)
+            return None
+        return ws_event_adapter.validate_python(self._unpack_model(_EVENT_CLASSES[data[0]], data))
+
+    def _unpack_model(self, cls: type[BaseModel], values: list) -> dict:
+        raw = dict(zip(cls.model_fields, values))
+        user = raw.get("user", raw.get("user_id"))
+        if "nickname" in raw and raw["nickname"] is None and user in self.users:
+            raw["nickname"] = self.users[user][1]
+        return {
+            name: self._unpack(field.annotation, raw[name])
+            for name, field in cls.model_fields.items()
+            if name in raw
+        }
+
+    def _unpack(self, annotation: Any, value: Any) -> Any:
+        origin, args = get_origin(annotation), get_args(annotation)
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            return self._unpack_model(annotation, value)
+        if annotation is uuid.UUID:
+            return self.users[value][0] if isinstance(value, int) else value
+        if origin in (list, List) and value is not None:
+            return [self._unpack(args[0], item) for item in value]
+        if origin in (dict, Dict) and value is not None:
+            return {self._unpack(args[0], key): self._unpack(args[1], item) for key, item in value.items()}
+        return value
 
 # RestAPI
 class GameData_Res(BaseModel):
+    seq: int = 0    # この時点のシーケンス番号（次回since=に指定すると差分だけを取得できる）
     genre: str
     ans_limit: int
     question_limit :int
@@ -100,6 +224,7 @@ class NewGame_Post(BaseModel):
     ans_limit:  int
     question_limit:int
     time_limit: datetime.timedelta
+    genres:     Optional[List[str]] = None  # お題リストのうち出題するジャンル（Noneならすべて）
 
 class ChangeTheme_Post(BaseModel):
     password: str
@@ -1,20 +1,39 @@
+import asyncio
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, WebSocketException
-from fastapi import HTTPException
+from fastapi import HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
-from ai import Ai_Agent
+from fastapi.responses import HTMLResponse, Response
+from contextlib import asynccontextmanager
+from ai import Ai_Agent, Ai_Overloaded
 import datetime
 import uuid
+from typing import Optional
 import schemes
 from dotenv import load_dotenv
 from os import environ
-from game_manager import GameManager, User_data
+from game_manager import GameManager, Game_data, User_data, Question_record, Answer_record
+from resources import Static_asset
+from state_backend import create_backend
+from routing import shard_filter
+from event_log import create_event_log
+from connection import Remote_socket
 from google.genai import errors as ai_errors
 
 load_dotenv()
-ai = Ai_Agent("gemini", "gemini-2.5-flash")
-#ai = Ai_Agent("openai", "gpt-5-mini")
-fastapi = FastAPI()
+# お題の検証結果キャッシュはdocker-compose.ymlでボリュームを割り当てたdata/に置く（"none"なら使わない）
+theme_cache_path = environ.get("THEME_CACHE_PATH", "data/theme_cache.jsonl")
+ai = Ai_Agent("gemini", "gemini-2.5-flash", theme_cache_path=None if theme_cache_path == "none" else theme_cache_path)
+#ai = Ai_Agent("openai", "gpt-5-mini", theme_cache_path=None if theme_cache_path == "none" else theme_cache_path)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 前回終了時のゲームを復元してから、次のゲーム用のお題の検証と、終了したゲームの退避を開始する
+    await game_manager.restore()
+    game_manager.start()
+    yield
+    await game_manager.close()
+
+fastapi = FastAPI(lifespan=lifespan)
 fastapi.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # すべてのオリジンを許可
@@ -22,14 +41,36 @@ fastapi.add_middleware(
     allow_methods=["*"],  # すべてのHTTPメソッドを許可
     allow_headers=["*"],  # すべてのヘッダーを許可
 )
-game_manager = GameManager(ai)
+# 複数のワーカーで動かす場合は、状態を共有するなら STATE_BACKEND=sqlite:///パス を、
+# ゲームIDごとにワーカーを振り分ける（router.py）ならWORKERSとWORKER_URLを指定する
+backend = create_backend(environ.get("STATE_BACKEND", "memory"))
+game_manager = GameManager(
+    ai,
+    backend=backend,
+    owns=shard_filter(environ.get("WORKERS"), environ.get("WORKER_URL")),
+    event_log=create_event_log(
+        environ.get("EVENT_LOG_DIR", "event_log"), environ.get("EVENT_LOG_FSYNC", "0"), environ.get("WORKER_URL"), backend.shared
+    ),
+    # 退避したゲームの記録先（"none"なら記録しない）
+    archive_path=None if environ.get("GAME_ARCHIVE_PATH") == "none" else environ.get("GAME_ARCHIVE_PATH", "data/game_archive.jsonl"),
+    # 同時に届いた回答をまとめて判定する待ち時間（秒）と件数の上限
+    answer_batch_window=float(environ.get("ANSWER_BATCH_WINDOW", "0.1")),
+    answer_batch_size=int(environ.get("ANSWER_BATCH_SIZE", "8")),
+)
+admin_page = Static_asset("admin.html")
 TZ = datetime.timezone(datetime.timedelta(hours=9))
 
 @fastapi.get("/", response_class=HTMLResponse)
-async def panel():
-    with open("admin.html","r", encoding="utf-8") as f:
-        html = f.read()
-    return html
+async def panel(request: Request):
+    page = admin_page.get()
+    # no-cacheで毎回ETagを確認させ、admin.htmlの更新がすぐ反映されるようにする
+    headers = {"ETag": page.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if page.etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return HTMLResponse(page.gzip_body, headers=headers)
+    return HTMLResponse(page.body, headers=headers)
 
 @fastapi.post("/new_game")
 async def post_new_game(data: schemes.NewGame_Post):
@@ -39,74 +80,123 @@ async def post_new_game(data: schemes.NewGame_Post):
         game_id = await game_manager.create_game(data)
     except ai_errors.ServerError as e:
         raise HTTPException(503, e.message)
+    except Ai_Overloaded:
+        raise HTTPException(503, "AI is overloaded.")
     return {"game_id": game_id}
 
 @fastapi.post("/game_list")
 async def get_game_list(data: schemes.GetGameList):
     if data.password != environ["password"]:
         raise HTTPException(403, "Password is incorrect")
-    l = {}
-    for id, game in game_manager.games.items():
-        l[id] = {
-            "status": game.state,
-            "answer": game.answer,
-            "connection_count": len(game.connections)
-        }
-    return l
+    return await game_manager.list_games()
+
+
+@fastapi.post("/stats")
+async def get_stats(data: schemes.GetGameList):
+    if data.password != environ["password"]:
+        raise HTTPException(403, "Password is incorrect")
+    return {
+        "ai": {
+            "retry": ai.retry_stats,
+            "question_cache": ai.question_cache.stats(),
+            "admission": ai.admission.stats(),
+            "single_flight": ai.single_flight.stats(),
+            "context_cache": ai.context_cache_stats(),
+            "theme_cache": ai.theme_cache.stats() if ai.theme_cache else None,
+        },
+        "prejudge": game_manager.prejudge_stats,
+        "answer_batch": game_manager.answer_batch_stats_summary(),
+        "question_latency": {name: recorder.stats() for name, recorder in game_manager.question_latency.items()},
+        "theme_pool": {"size": len(game_manager.theme_pool), **game_manager.pool_stats},
+        "themes": game_manager.themes.stats(),
+        "admin_page": admin_page.stats(),
+        "games": game_manager.memory_stats(),
+        "event_log": game_manager.event_log.stats() if game_manager.event_log else None,
+        "restore": game_manager.restore_stats,
+        "backend": {
+            **game_manager.backend.stats(),
+            "relays": len(game_manager.relays),
+            "remote_sockets": len(game_manager.remote_sockets),
+            **game_manager.relay_stats,
+        },
+    }
+
+
+@fastapi.post("/themes")
+async def get_themes(data: schemes.GetGameList):
+    if data.password != environ["password"]:
+        raise HTTPException(403, "Password is incorrect")
+    return {
+        "entries": game_manager.themes.entries(),
+        **game_manager.themes.stats(),
+    }
+
+
+@fastapi.post("/{game_id}/connections")
+async def get_connection_stats(game_id: int, data: schemes.GetGameList):
+    if data.password != environ["password"]:
+        raise HTTPException(403, "Password is incorrect")
+    game = game_manager.get_game(game_id)
+    if not game:
+        raise HTTPException(404, "Unknown game ID.")
+    return game.connection_stats()
 
 
 @fastapi.post("/{game_id}/change_theme")
 async def post_change_theme(game_id: int, data: schemes.ChangeTheme_Post):
     if data.password != environ["password"]:
         raise HTTPException(403, "Password is incorect")
-    game = game_manager.get_game(game_id)
-    if not game:
+    if not await game_manager.set_next_answer(game_id, data.answer):
         raise HTTPException(404, "Unknown game ID.")
-    game.manual_next_answer = data.answer
-    if game.state == "finished":
-        game.state = "redirected"
     return {"message": "Theme for the next game has been changed."}
 
 
 @fastapi.get("/{game_id}/", response_model=schemes.GameData_Res)
-async def get_gamedata(game_id: int, user_id: uuid.UUID):
+async def get_gamedata(game_id: int, user_id: uuid.UUID, since: Optional[int] = None):
     game = game_manager.get_game(game_id)
     if not game:
-        raise HTTPException(404, "Unknown game ID.")
-
-    return schemes.GameData_Res(
-        messages=game.messages,
-        genre=game.genre,
-        ans_limit=game.ans_limit,
-        question_limit=game.question_limit,
-        start_time=game.start_time,
-        end_time=game.end_time,
-        status=game.state,
-        users={uid:user.nickname for uid, user in game.users.items()}
-    )
+        # 他のワーカーのゲームなら、そのワーカーが書き込んだ最新の状態を返す
+        detail = await game_manager.backend.game_detail(game_id, since)
+        if detail is None:
+            raise HTTPException(404, "Unknown game ID.")
+        return Response(detail, media_type="application/json")
+    return game.to_scheme(since)
 
 
 @fastapi.websocket("/{game_id}/")
 async def websocket_broadcast(ws: WebSocket, game_id: int):
-    try:
-        game = game_manager.get_game(game_id)
-        if not game:
+    game = game_manager.get_game(game_id)
+    if not game:
+        # 他のワーカーのゲームなら、そのワーカーに中継する
+        owner = await game_manager.backend.owner(game_id)
+        if owner is None:
             # Consider sending a WebSocket close message with a proper code
             await ws.close(code=4000, reason="Unknown game ID.")
             return
-
         await ws.accept()
-        game.connections[ws] = None
+        await game_manager.relay(ws, game_id, owner)
+        return
+
+    await ws.accept()
+    await serve_connection(ws, game)
+
+
+# WebSocketの受信処理（他のワーカーから中継された接続はRemote_socketで受け取る）
+async def serve_connection(ws: WebSocket | Remote_socket, game: Game_data):
+    try:
+        # ?encoding=msgpack でコンパクトエンコーディングを使う（既定はJSON）
+        encoding = ws.query_params.get("encoding", "json")
+        game.add_connection(ws, encoding if encoding == schemes.COMPACT_ENCODING else "json")
         while True:
             if game.state == "redirected":
-                await ws.send_text(schemes.NewGame_Redirect(game_id=game.new_game_id or 0).model_dump_json())
-            msg = await ws.receive_json()
-            data = schemes.WSEvent.model_validate({"root":msg})
-            data = data.root
+                game.send(ws, schemes.WSEvent(root=schemes.NewGame_Redirect(game_id=game.new_game_id or 0)))
+            msg = await ws.receive_text()
+            data = schemes.ws_event_adapter.validate_json(msg)
             # ここから受信内容のタイプ別に処理
             if data.type == "join_declare":
                 if data.user in game.users:
-                    game.connections[ws] = data.user
+                    game.bind_connection(ws, data.user)
+                    game.send(ws, schemes.WSEvent(root=game.status_event()))
                     continue
                 user = User_data(
                     user_id=data.user,
@@ -115,8 +205,9 @@ async def websocket_broadcast(ws: WebSocket, game_id: int):
                     remaining_answering=game.ans_limit if data.is_player else 0,
                     remaining_question=game.question_limit if data.is_player else 0,
                 )
-                game.users[user.user_id] = user
-                game.connections[ws] = user.user_id
+                game.add_user(user)
+                game.bind_connection(ws, user.user_id)
+                game.send(ws, schemes.WSEvent(root=game.status_event()))
 
             elif data.type == "ready":
                 if game.state != "waiting":
@@ -125,39 +216,42 @@ async def websocket_broadcast(ws: WebSocket, game_id: int):
                 if not user:
                     continue
 
-                user.is_ready = True
+                game.mark_ready(user)
                 await game.check_all_ready()
 
             elif data.type == "question":
                 if game.state != "playing":
-                    await ws.send_text(
-                        schemes.WSEvent(root=schemes.Response(text="ゲーム中ではありません。")).root.model_dump_json()
-                    )
+                    game.send(ws, schemes.WSEvent(root=schemes.Response(text="ゲーム中ではありません。")))
                     continue
 
                 user = game.users[data.user]
                 if user.remaining_question == 0:
-                    await ws.send_text(schemes.Response(text="質問権がありません。").model_dump_json())
+                    game.send(ws, schemes.WSEvent(root=schemes.Response(text="質問権がありません。")))
                     continue
                 if user.answered_correctly:
-                    await ws.send_text(
-                        schemes.WSEvent(
-                            root=schemes.Response(text="すでに正解済みです。")
-                        ).root.model_dump_json()
-                    )
+                    game.send(ws, schemes.WSEvent(root=schemes.Response(text="すでに正解済みです。")))
                     continue
                 try:
-                    res = await game.ai_question(data.text)
+                    # 返答の一言が確定したら、全体を待たずに質問者へ先に返す
+                    res = await game.ai_question(
+                        data.text,
+                        on_reply=lambda reply: game.send(ws, schemes.WSEvent(root=schemes.Response(text=f"回答：{reply}", partial=True))),
+                    )
+                except Ai_Overloaded:
+                    game.send(ws, schemes.WSEvent(root=schemes.Response(text="AIが混雑しています。しばらくしてからもう一度お試しください。")))
+                    continue
+                except asyncio.TimeoutError:
+                    game.send(ws, schemes.WSEvent(root=schemes.Response(text="時間内に判定できませんでした。")))
+                    continue
                 except Exception as e:
-                    await ws.send_text(schemes.Response(text=f"AI処理中にエラーが発生しました：{e.args}").model_dump_json())
-                    return
+                    game.send(ws, schemes.WSEvent(root=schemes.Response(text=f"AI処理中にエラーが発生しました：{e.args}")))
+                    continue
                 # レスポンス
-                game.users[data.user].remaining_question -= 1
-                await ws.send_text(schemes.Response(text=f"回答：{res.reply}（{res.reason}）").model_dump_json())
-                broadcast_data = schemes.Res_Question(
+                game.record_question(user)
+                game.send(ws, schemes.WSEvent(root=schemes.Response(text=f"回答：{res.reply}（{res.reason}）")))
+                record = Question_record(
                     time=datetime.datetime.now(TZ),
-                    user=user.user_id,
-                    nickname=user.nickname,
+                    user=user,
                     include_answer=res.include_answer,
                     title=res.reply,
                     question=data.text,
@@ -165,62 +259,53 @@ async def websocket_broadcast(ws: WebSocket, game_id: int):
                     remaining_count=user.remaining_question
                 )
 
-                # 配信
-                game.messages.append(broadcast_data)
-                await game.broadcast(schemes.WSEvent(root=broadcast_data))
+                # 履歴に追加して配信
+                game.append_message(record)
 
             elif data.type == "answer":
                 if game.state != "playing":
-                    await ws.send_text(
-                        schemes.WSEvent(root=schemes.Response(text="ゲーム中ではありません。")).root.model_dump_json()
-                    )
+                    game.send(ws, schemes.WSEvent(root=schemes.Response(text="ゲーム中ではありません。")))
                     continue
 
                 user = game.users[data.user]
                 
                 if user.remaining_answering == 0:
-                    await ws.send_text(
-                        schemes.WSEvent(
-                            root=schemes.Response(text="回答権はもうありません。")
-                        ).root.model_dump_json()
-                    )
+                    game.send(ws, schemes.WSEvent(root=schemes.Response(text="回答権はもうありません。")))
                     continue
                 if user.answered_correctly:
-                    await ws.send_text(
-                        schemes.WSEvent(
-                            root=schemes.Response(text="すでに正解済みです。")
-                        ).root.model_dump_json()
-                    )
+                    game.send(ws, schemes.WSEvent(root=schemes.Response(text="すでに正解済みです。")))
                     continue
                 try:
                     answered_at = datetime.datetime.now(TZ)
                     res = await game.ai_answer(data.text)
+                except Ai_Overloaded:
+                    game.send(ws, schemes.WSEvent(root=schemes.Response(text="AIが混雑しています。しばらくしてからもう一度お試しください。")))
+                    continue
+                except asyncio.TimeoutError:
+                    game.send(ws, schemes.WSEvent(root=schemes.Response(text="時間内に判定できませんでした。")))
+                    continue
                 except Exception as e:
-                    await ws.send_text(schemes.Response(text=f"AI処理中にエラーが発生しました：{e.args}").model_dump_json())
-                    return
+                    game.send(ws, schemes.WSEvent(root=schemes.Response(text=f"AI処理中にエラーが発生しました：{e.args}")))
+                    continue
     
-                if res.is_correct:
-                    user.answered_correctly = True
-                    user.answered_at = answered_at
-                    game.correct_answerer.append(user)
-
-                user.remaining_answering -= 1
+                game.record_answer(user, res.is_correct, answered_at)
                 # レスポンス
-                await ws.send_text(schemes.Response(text=f"{"正解" if res.is_correct else "不正解"}").model_dump_json())
-                broadcast_data = schemes.Res_Answer(
+                game.send(ws, schemes.WSEvent(root=schemes.Response(text=f"{"正解" if res.is_correct else "不正解"}")))
+                record = Answer_record(
                     time=datetime.datetime.now(TZ),
-                    user=user.user_id,
-                    nickname=user.nickname,
+                    user=user,
                     include_answer=res.is_close or res.is_correct,
                     judge=res.is_correct,
                     answer=data.text if not res.is_correct or res.is_close else "",
                     remaining_count=user.remaining_answering
                 )
 
-                # 配信
-                game.messages.append(broadcast_data)
-                await game.broadcast(schemes.WSEvent(root=broadcast_data))
+                # 履歴に追加して配信
+                game.append_message(record)
 
     except (WebSocketDisconnect, WebSocketException):
-        if game and ws in game.connections:
-            del game.connections[ws]
\ No newline at end of file
+        pass
+    finally:
+        game.remove_connection(ws)
+
+game_manager.on_remote_connection = serve_connection
\ No newline at end of file
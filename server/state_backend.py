@@ -0,0 +1,277 @@
+import asyncio
+import json
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+# ゲームの所在とワーカー間のメッセージを管理する状態バックエンド
+# ゲーム本体（Game_data）は作成したワーカー（オーナー）のメモリにあり、
+# 他のワーカーに接続したプレイヤーの通信はメッセージとしてオーナーとの間で中継する
+# 書き込み（update_game・remove_game・publish）は待たずに順番に反映し、読み出しはawaitする
+class State_backend(ABC):
+    shared = False  # 他のワーカーと状態を共有するか
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+
+    # ゲームIDを自分のものとして登録する。すでに使われていればFalse
+    @abstractmethod
+    async def register_game(self, game_id: int) -> bool: ...
+
+    # 他のワーカーが一覧・詳細の取得に使う要約（game_list用）と、メッセージを除いた詳細（GameData_Res）、
+    # 前回の書き込み以降に追加されたメッセージ（シーケンス番号とRes_Question・Res_AnswerのJSON）
+    @abstractmethod
+    def update_game(self, game_id: int, summary: dict, detail: str, messages: list[tuple[int, str]]): ...
+
+    @abstractmethod
+    def remove_game(self, game_id: int): ...
+
+    # ゲームを持っているワーカーのID
+    @abstractmethod
+    async def owner(self, game_id: int) -> Optional[str]: ...
+
+    @abstractmethod
+    async def games(self) -> dict[int, dict]: ...
+
+    # GameData_ResのJSON。sinceを指定した場合はそれより後のメッセージだけを含める
+    @abstractmethod
+    async def game_detail(self, game_id: int, since: Optional[int] = None) -> Optional[str]: ...
+
+    # worker_id宛てにメッセージを送る
+    @abstractmethod
+    def publish(self, worker_id: str, message: dict): ...
+
+    # 自分宛てのメッセージを届いた順に受け取る
+    @abstractmethod
+    def messages(self) -> AsyncIterator[dict]: ...
+
+    def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"type": type(self).__name__, "worker_id": self.worker_id}
+
+
+# 1プロセスだけで動かす場合のバックエンド
+class Memory_backend(State_backend):
+    def __init__(self):
+        super().__init__()
+        self._games: set[int] = set()
+        self._queue: asyncio.Queue[dict] = asyncio.Queue()
+
+    async def register_game(self, game_id: int) -> bool:
+        if game_id in self._games:
+            return False
+        self._games.add(game_id)
+        return True
+
+    def update_game(self, game_id: int, summary: dict, detail: str, messages: list[tuple[int, str]]):
+        pass
+
+    def remove_game(self, game_id: int):
+        self._games.discard(game_id)
+
+    async def owner(self, game_id: int) -> Optional[str]:
+        return self.worker_id if game_id in self._games else None
+
+    async def games(self) -> dict[int, dict]:
+        return {}
+
+    async def game_detail(self, game_id: int, since: Optional[int] = None) -> Optional[str]:
+        return None
+
+    def publish(self, worker_id: str, message: dict):
+        if worker_id == self.worker_id:
+            self._queue.put_nowait(message)
+
+    async def messages(self) -> AsyncIterator[dict]:
+        while True:
+            yield await self._queue.get()
+
+
+# 同じマシン上の複数のワーカー（uvicorn --workers）で共有するSQLiteのバックエンド
+# メッセージはテーブルに書き込み、宛先のワーカーがpoll_intervalごとに読み出す
+# SQLiteへのアクセスはすべて専用のスレッド1本で順番に行い、イベントループを止めない
+class Sqlite_backend(State_backend):
+    shared = True
+
+    def __init__(self, path: str, poll_interval: float = 0.02, heartbeat_interval: float = 2.0, stale_after: float = 10.0):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval              # メッセージを確認する間隔（秒）
+        self.heartbeat_interval = heartbeat_interval    # 生存を記録する間隔（秒）
+        self.stale_after = stale_after                  # この秒数生存の記録がないワーカーのゲームは捨てる
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5.0)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, seen REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS games (game_id INTEGER PRIMARY KEY, worker TEXT NOT NULL, summary TEXT NOT NULL, detail TEXT);
+            CREATE TABLE IF NOT EXISTS game_messages (game_id INTEGER NOT NULL, seq INTEGER NOT NULL, body TEXT NOT NULL, PRIMARY KEY (game_id, seq));
+            CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, worker TEXT NOT NULL, body TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS messages_worker ON messages (worker, id);
+        """)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite_backend")
+        self.published = 0
+        self.received = 0
+        self.pending_writes = 0     # スレッドでの反映待ちの書き込み
+        self.worker_count = 0       # 直近の生存確認で数えたワーカー数
+        self._heartbeat()
+
+    # スレッドで実行して結果を待つ
+    async def _run(self, fn: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # スレッドで実行し、結果は待たない（送った順に反映される）
+    def _submit(self, fn: Callable, *args):
+        self.pending_writes += 1
+        self._executor.submit(fn, *args).add_done_callback(self._written)
+
+    def _written(self, future: Future):
+        self.pending_writes -= 1
+        if future.exception():
+            print(f"[backend] write failed: {future.exception()!r}")
+
+    def _heartbeat(self):
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO workers (worker, seen) VALUES (?, ?)", (self.worker_id, now))
+        # 止まったワーカーのゲームとメッセージを片付ける
+        stale = [row[0] for row in self.db.execute("SELECT worker FROM workers WHERE seen < ?", (now - self.stale_after,))]
+        for worker in stale:
+            self.db.execute("DELETE FROM game_messages WHERE game_id IN (SELECT game_id FROM games WHERE worker = ?)", (worker,))
+            self.db.execute("DELETE FROM games WHERE worker = ?", (worker,))
+            self.db.execute("DELETE FROM messages WHERE worker = ?", (worker,))
+            self.db.execute("DELETE FROM workers WHERE worker = ?", (worker,))
+            print(f"[backend] worker {worker} is gone")
+        self.worker_count = self.db.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+
+    def _register_game(self, game_id: int) -> bool:
+        cur = self.db.execute(
+            "INSERT OR IGNORE INTO games (game_id, worker, summary) VALUES (?, ?, '{}')",
+            (game_id, self.worker_id),
+        )
+        if cur.rowcount == 1:
+            # 前に同じIDを使っていたゲームのメッセージを消す
+            self.db.execute("DELETE FROM game_messages WHERE game_id = ?", (game_id,))
+        return cur.rowcount == 1
+
+    async def register_game(self, game_id: int) -> bool:
+        return await self._run(self._register_game, game_id)
+
+    def _update_game(self, game_id: int, summary: str, detail: str, messages: list[tuple[int, str]]):
+        cur = self.db.execute(
+            "UPDATE games SET summary = ?, detail = ? WHERE game_id = ? AND worker = ?",
+            (summary, detail, game_id, self.worker_id),
+        )
+        if cur.rowcount and messages:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO game_messages (game_id, seq, body) VALUES (?, ?, ?)",
+                [(game_id, seq, body) for seq, body in messages],
+            )
+
+    def update_game(self, game_id: int, summary: dict, detail: str, messages: list[tuple[int, str]]):
+        self._submit(self._update_game, game_id, json.dumps(summary, ensure_ascii=False), detail, messages)
+
+    def _remove_game(self, game_id: int):
+        cur = self.db.execute("DELETE FROM games WHERE game_id = ? AND worker = ?", (game_id, self.worker_id))
+        if cur.rowcount:
+            self.db.execute("DELETE FROM game_messages WHERE game_id = ?", (game_id,))
+
+    def remove_game(self, game_id: int):
+        self._submit(self._remove_game, game_id)
+
+    def _owner(self, game_id: int) -> Optional[str]:
+        row = self.db.execute("SELECT worker FROM games WHERE game_id = ?", (game_id,)).fetchone()
+        return row[0] if row else None
+
+    async def owner(self, game_id: int) -> Optional[str]:
+        return await self._run(self._owner, game_id)
+
+    def _games(self) -> dict[int, dict]:
+        return {
+            game_id: json.loads(summary)
+            for game_id, summary in self.db.execute("SELECT game_id, summary FROM games")
+        }
+
+    async def games(self) -> dict[int, dict]:
+        return await self._run(self._games)
+
+    def _game_detail(self, game_id: int, since: Optional[int]) -> Optional[str]:
+        row = self.db.execute("SELECT detail FROM games WHERE game_id = ?", (game_id,)).fetchone()
+        if not row or row[0] is None:
+            return None
+        bodies = [body for body, in self.db.execute(
+            "SELECT body FROM game_messages WHERE game_id = ? AND seq > ? ORDER BY seq",
+            (game_id, since or 0),
+        )]
+        # 詳細のmessages（空の配列）を保存済みのメッセージに差し替える
+        detail = json.loads(row[0])
+        detail["messages"] = [json.loads(body) for body in bodies]
+        return json.dumps(detail, ensure_ascii=False)
+
+    async def game_detail(self, game_id: int, since: Optional[int] = None) -> Optional[str]:
+        return await self._run(self._game_detail, game_id, since)
+
+    def _publish(self, worker_id: str, body: str):
+        self.db.execute("INSERT INTO messages (worker, body) VALUES (?, ?)", (worker_id, body))
+
+    def publish(self, worker_id: str, message: dict):
+        self._submit(self._publish, worker_id, json.dumps(message, ensure_ascii=False, separators=(",", ":")))
+        self.published += 1
+
+    def _take_messages(self) -> list[str]:
+        rows = self.db.execute(
+            "SELECT id, body FROM messages WHERE worker = ? ORDER BY id LIMIT 500",
+            (self.worker_id,),
+        ).fetchall()
+        if rows:
+            self.db.execute("DELETE FROM messages WHERE worker = ? AND id <= ?", (self.worker_id, rows[-1][0]))
+        return [body for _, body in rows]
+
+    async def messages(self) -> AsyncIterator[dict]:
+        heartbeat_at = time.monotonic()
+        while True:
+            if time.monotonic() - heartbeat_at >= self.heartbeat_interval:
+                await self._run(self._heartbeat)
+                heartbeat_at = time.monotonic()
+            bodies = await self._run(self._take_messages)
+            if not bodies:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            for body in bodies:
+                self.received += 1
+                yield json.loads(body)
+
+    def close(self):
+        # 反映待ちの書き込みを終えてから片付ける
+        self._executor.shutdown(wait=True)
+        self.db.execute("DELETE FROM game_messages WHERE game_id IN (SELECT game_id FROM games WHERE worker = ?)", (self.worker_id,))
+        self.db.execute("DELETE FROM games WHERE worker = ?", (self.worker_id,))
+        self.db.execute("DELETE FROM messages WHERE worker = ?", (self.worker_id,))
+        self.db.execute("DELETE FROM workers WHERE worker = ?", (self.worker_id,))
+        self.db.close()
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "path": self.path,
+            "workers": self.worker_count,
+            "published": self.published,
+            "received": self.received,
+            "pending_writes": self.pending_writes,
+        }
+
+
+# STATE_BACKEND環境変数の値からバックエンドを作る（"memory" または "sqlite:///パス"）
+def create_backend(url: str) -> State_backend:
+    if url == "memory":
+        return Memory_backend()
+    if url.startswith("sqlite:///"):
+        return Sqlite_backend(url.removeprefix("sqlite:///"))
+    raise ValueError(f"Unknown state backend: {url}")
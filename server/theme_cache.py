@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import json
+import os
+from typing import TYPE_CHECKING, Optional
+
+from resources import parse_themes
+
+if TYPE_CHECKING:
+    from ai import Ai_Agent
+
+
+# check_game_themaの結果をお題の原文ごとに保存するJSON Linesファイル
+# 各行: {"key": お題の原文, "fingerprint": プロンプト・モデルの指紋, "result": 検証結果}
+class Theme_cache:
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.fingerprint = fingerprint      # プロンプトやモデルが変わると変化し、古い結果は無効になる
+        self.entries: dict[str, dict] = {}
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.load()
+
+    def load(self):
+        self.entries.clear()
+        if not os.path.exists(self.path):
+            return
+        stale = 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    stale += 1
+                    continue
+                if record.get("fingerprint") != self.fingerprint:
+                    stale += 1
+                    continue
+                self.entries[record["key"]] = record["result"]
+        # 無効になった行があればファイルを書き直す
+        if stale:
+            self._rewrite()
+
+    def get(self, key: str) -> Optional[dict]:
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def set(self, key: str, result: dict):
+        self.entries[key] = result
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(self._dumps(key, result) + "\n")
+
+    def invalidate(self, key: Optional[str] = None):
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+        self._rewrite()
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+    def _dumps(self, key: str, result: dict) -> str:
+        return json.dumps({"key": key, "fingerprint": self.fingerprint, "result": result}, ensure_ascii=False)
+
+    def _rewrite(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, result in self.entries.items():
+                f.write(self._dumps(key, result) + "\n")
+        os.replace(tmp_path, self.path)
+
+
+# お題リストをまとめて検証し、キャッシュに保存する
+# 同時に検証する数はconcurrencyまでに抑える（AIの待ち行列が一杯になるとAi_Overloadedで失敗するため）
+async def preload(ai_agent: "Ai_Agent", themes_path: str, force: bool = False, concurrency: Optional[int] = None):
+    with open(themes_path, "rb") as f:
+        themes = [entry.theme for entry in parse_themes(f.read())]
+    if ai_agent.theme_cache is None:
+        raise RuntimeError("theme_cacheが設定されていません")
+    if force:
+        for theme in themes:
+            ai_agent.theme_cache.entries.pop(theme, None)
+
+    semaphore = asyncio.Semaphore(concurrency or ai_agent.admission.max_in_flight)
+
+    async def check(theme: str):
+        async with semaphore:
+            return await ai_agent.check_game_thema(theme)
+
+    results = await asyncio.gather(*(check(theme) for theme in themes), return_exceptions=True)
+    for theme, res in zip(themes, results):
+        if isinstance(res, BaseException):
+            print(f"NG  {theme}: {res!r}")
+        else:
+            print(f"{'OK' if res.is_useable else '不可'}  {theme} → {res.thema}（{res.genre}）")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="お題の検証結果キャッシュを操作します")
+    sub = parser.add_subparsers(dest="command", required=True)
+    preload_parser = sub.add_parser("preload", help="お題リストをまとめて検証する")
+    preload_parser.add_argument("themes", nargs="?", default="themes.txt")
+    preload_parser.add_argument("--force", action="store_true", help="検証済みのお題も再検証する")
+    preload_parser.add_argument("--concurrency", type=int, default=None, help="同時に検証する数（既定はAIの同時実行数の上限）")
+    sub.add_parser("clear", help="キャッシュをすべて削除する")
+    # server.pyのAIと同じ設定にする（キャッシュの指紋はAIの種類とモデルで決まる）
+    parser.add_argument("--type", choices=["gemini", "openai"], default="gemini")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--cache", default=os.environ.get("THEME_CACHE_PATH", "data/theme_cache.jsonl"), help="キャッシュファイルのパス")
+    args = parser.parse_args()
+
+    # serverをimportするとゲームの管理やイベントログまで作られるので、AIだけを作る
+    from ai import Ai_Agent
+    ai = Ai_Agent(args.type, args.model, theme_cache_path=args.cache)
+
+    if args.command == "preload":
+        asyncio.run(preload(ai, args.themes, force=args.force, concurrency=args.concurrency))
+    elif args.command == "clear" and ai.theme_cache:
+        ai.theme_cache.invalidate()